@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# benchmark.py
+# Benchmarks for reaper.py
+# (c) 2013 Ben Last <ben@benlast.com>
+
+#Standard modules
+import os, sys, argparse, time, resource, multiprocessing, subprocess
+
+import reaper
+
+#The default proportions of instances in each state in a synthetic fleet
+STATEMIX="running=60,stopped=30,pending=5,terminated=5"
+
+def parseMix(arg):
+    """Parse a comma-separated list of state=weight values into a list of (state,weight) tuples."""
+    return [(k,int(v)) for (k,v) in map(reaper.splitKV,reaper.splitList(arg))]
+
+def syntheticData(n,tags=10,mix=parseMix(STATEMIX),template=eval(reaper.TESTDATA)[0]):
+    """Return the instance data dict for instance number n of a synthetic fleet.  Every attribute of the
+    reaper test data is present, as for a real instance.  States are assigned in the proportions given
+    by mix, a list of (state,weight) tuples, and the env and owner tags each take one of tags values.
+    The same n always gives the same data, so a fleet never needs to be held in memory."""
+    data=dict(template)
+    position=n%sum(w for (s,w) in mix)
+    for (state,weight) in mix:
+        if position<weight:
+            break
+        position-=weight
+    data["id"]="i-%08x"%n
+    data["state"]=state
+    data["tags"]={"Name":"host%d"%n,"Env":"env%d"%(n%tags),"Owner":"owner%d"%((n*7)%tags)}
+    return data
+
+def fleet(count,tags=10,mix=parseMix(STATEMIX)):
+    """Return a list of count test Instances from a synthetic fleet."""
+    return [reaper.Instance(syntheticData(n,tags,mix)) for n in xrange(count)]
+
+def fakeBackend(count,tags=10,mix=parseMix(STATEMIX),latency=0.0,throttle=0.0):
+    """Return a reaper.FakeBackend serving a synthetic fleet of count instances, whose API calls each
+    take latency seconds and are throttled at random in the proportion throttle."""
+    return reaper.FakeBackend(lambda n: syntheticData(n,tags,mix),count,["fake"],latency=latency,throttle=throttle)
+
+class BotoInstance(object):
+    """Stands in for a boto.ec2.instance.Instance: an object with the test data as its attributes."""
+    def __init__(self,data):
+        self.__dict__.update(data)
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def terminate(self):
+        pass
+
+def botoFleet(count):
+    """Return a list of count BotoInstances, each with all the attributes of the reaper test data."""
+    template=eval(reaper.TESTDATA)[0]
+    result=[]
+    for n in xrange(count):
+        data=dict(template)
+        data["id"]="i-%08x"%n
+        data["tags"]={"Name":"host%d"%n,"Env":"dev"}
+        result.append(BotoInstance(data))
+    return result
+
+class LegacyInstance:
+    """The Instance class as it was before it used __slots__: every attribute of the boto object is
+    copied into the instance dict."""
+    def __init__(self,data):
+        map(lambda (k,v): setattr(self,k,v),((k,v) for (k,v) in data.__dict__.iteritems() if not k.startswith('__')))
+        self.start=data.start
+        self.stop=data.stop
+        self.terminate=data.terminate
+        self.tags=dict([(a.lower(),b) for (a,b) in self.tags.iteritems()])
+        self.instance=data
+
+def recordSize(instance):
+    """Return the number of bytes used by an Instance or LegacyInstance itself, including its own
+    dicts but not the underlying object or the attribute values it shares with that object."""
+    size=sys.getsizeof(instance)+sys.getsizeof(instance.tags)
+    if isinstance(instance,reaper.Instance):
+        if instance._extra is not None:
+            size+=sys.getsizeof(instance._extra)
+    else:
+        size+=sys.getsizeof(instance.__dict__)
+        #The bound methods are created by the copy
+        size+=sum(sys.getsizeof(getattr(instance,m)) for m in ("start","stop","terminate"))
+    return size
+
+def benchmarkWrap(count):
+    """Compare the time taken and memory used to wrap count boto instances as Instances and as
+    LegacyInstances, and print the results."""
+    objects=botoFleet(count)
+    fields=["instance_type"]
+    (legacy,legacyInstances)=timed(lambda: [LegacyInstance(o) for o in objects])
+    (compact,instances)=timed(lambda: [reaper.Instance(o,fields) for o in objects])
+    legacySize=sum(recordSize(i) for i in legacyInstances)/float(count)
+    compactSize=sum(recordSize(i) for i in instances)/float(count)
+    print "wrap   %7d instances: legacy %.3fs %5d bytes each, compact %.3fs %5d bytes each"%(count,
+        legacy,legacySize,compact,compactSize)
+
+def measure(function,*args):
+    """Call function(*args) in a child process, so that its memory use can be measured separately.
+    Return a (seconds,kilobytes,result) tuple, where kilobytes is the increase in peak memory use."""
+    results=multiprocessing.Queue()
+    def child():
+        base=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        (seconds,result)=timed(function,*args)
+        results.put((seconds,resource.getrusage(resource.RUSAGE_SELF).ru_maxrss-base,result))
+    process=multiprocessing.Process(target=child)
+    process.start()
+    result=results.get()
+    process.join()
+    return result
+
+def pipeline(phase,count,tags,mix,latency,throttle,pageSize,batchSize,inFlight,apiRate):
+    """Run the reaper pipeline over a fake backend as far as the given phase (enumerate, filter or act)
+    and return the number of instances that came out of the last phase.  API calls are scheduled at up
+    to apiRate calls per second, and throttled calls are retried after a short backoff."""
+    reaper.SCHEDULER=reaper.Scheduler(rate=apiRate,burst=max(1,int(apiRate)),concurrency=max(inFlight,reaper.APICONCURRENCY),
+        retries=100,backoff=0.001,maxBackoff=0.01)
+    reaper.BACKEND=fakeBackend(count,tags,mix,latency,throttle)
+    includes=reaper.createFilterList([("state","running",False),("tags.env","env[0-4]",True)])
+    excludes=reaper.createFilterList(excludeList(100))
+    instances=reaper.getRegionInstances(["fake"],pageSize,fields=reaper.filterFields(includes+excludes))
+    if phase!="enumerate":
+        instances=reaper.filtered(instances,includes,excludes)
+    if phase!="act":
+        return sum(1 for i in instances)
+    batcher=reaper.ActionBatcher(batchSize,inFlight=inFlight)
+    reaper.act(instances,"stop",batcher)
+    batcher.flush()
+    return sum(len(r.succeeded) for r in batcher.results)
+
+def benchmarkPipeline(count,tags,mix,latency,throttle,pageSize,batchSize,inFlight,apiRate):
+    """Measure and print the throughput and peak memory use of enumeration, filtering and action
+    dispatch for a synthetic fleet of count instances, with inFlight action calls at a time."""
+    for phase in ("enumerate","filter","act"):
+        (seconds,kilobytes,result)=measure(pipeline,phase,count,tags,mix,latency,throttle,pageSize,batchSize,inFlight,apiRate)
+        print "%-9s %7d instances: %7d out in %.3fs, %8d instances/s, peak memory +%dKB"%(phase,count,result,
+            seconds,count/seconds if seconds else 0,kilobytes)
+
+def benchmarkStartup(runs):
+    """Run reaper.py with --help and with --test runs times each, and print the fastest and median wall
+    times, so that changes in startup cost show up.  The time to import boto is shown for comparison.
+    A command that fails is reported as failed rather than timed, so that (for example) a missing boto
+    isn't mistaken for a cheap import."""
+    script=os.path.join(os.path.dirname(os.path.abspath(reaper.__file__)),"reaper.py")
+    with open(os.devnull,"w") as devnull:
+        for (name,command) in (("--help",[sys.executable,script,"--help"]),("--test",[sys.executable,script,"--test"]),
+                ("boto",[sys.executable,"-c","import boto.ec2"])):
+            results=[timed(subprocess.call,command,stdout=devnull,stderr=devnull) for n in xrange(runs)]
+            failed=[status for (seconds,status) in results if status!=0]
+            if failed:
+                print "startup %-6s failed with exit status %d, not timed"%(name,failed[0])
+                continue
+            times=sorted(seconds for (seconds,status) in results)
+            print "startup %-6s %3d runs: fastest %.3fs median %.3fs"%(name,runs,times[0],times[len(times)/2])
+
+def excludeList(count):
+    """Return a list of (keyword,value,isRegex) tuples for a typical large exclude list: protected
+    ids and names, plus a few regexes on names."""
+    excludes=[("id","i-%08x"%(n*7),False) for n in xrange(count/2)]
+    excludes+=[("tags.name","host%d"%(n*11),False) for n in xrange(count/2)]
+    excludes+=[("tags.name","db%d-.*"%n,True) for n in xrange(5)]
+    return excludes
+
+def legacyFiltered(instances,includes,excludes):
+    """The filtering that filtered() did before FilterSet: every Filter is called in turn."""
+    if includes:
+        instances=[i for i in instances if any(f(i) for f in includes)]
+    if excludes:
+        instances=[i for i in instances if not any(f(i) for f in excludes)]
+    return instances
+
+def timed(function,*args,**kwargs):
+    """Call function with args and kwargs and return a (seconds,result) tuple."""
+    started=time.time()
+    result=function(*args,**kwargs)
+    return (time.time()-started,result)
+
+def benchmarkFilters(count,excludes):
+    """Compare filtered() against legacyFiltered() for count instances and an exclude list of the
+    given length, and print the time taken by each."""
+    instances=fleet(count)
+    includes=reaper.createFilterList([("state","running",False),("state","pending",False)])
+    excludes=reaper.createFilterList(excludeList(excludes))
+    (legacy,expected)=timed(legacyFiltered,instances,includes,excludes)
+    (compiled,result)=timed(lambda *a: list(reaper.filtered(*a)),instances,includes,excludes)
+    assert result==expected,"filtered() and legacyFiltered() disagree"
+    print "filter %7d instances %4d excludes: legacy %.3fs compiled %.3fs (%.1fx)"%(count,len(excludes),
+        legacy,compiled,legacy/compiled if compiled else 0)
+
+def arguments(args=sys.argv[1:]):
+    """Parse command line arguments and return the result of parsing."""
+    parser=argparse.ArgumentParser(description="Run benchmarks for reaper.py.  All of them run offline.")
+    parser.add_argument('-b','--benchmark',action='append',dest='benchmarks',choices=['startup','wrap','filter','pipeline'],
+        help="Specify a benchmark to run (may be repeated, default all)")
+    parser.add_argument('-n','--count',action='append',type=int,dest='counts',
+        help="Specify a number of instances to benchmark with (may be repeated)")
+    parser.add_argument('-s','--size',action='append',type=int,dest='sizes',
+        help="Specify a fleet size for the pipeline benchmark (may be repeated, default 1000, 10000 and 100000)")
+    parser.add_argument('-t','--tags',action='store',type=int,dest='tags',default=10,
+        help="Specify the number of distinct values of each tag in a synthetic fleet (default 10)")
+    parser.add_argument('-m','--mix',action='store',type=parseMix,dest='mix',default=parseMix(STATEMIX),
+        help="Specify the proportions of instance states in a synthetic fleet (default %s)"%STATEMIX)
+    parser.add_argument('-l','--latency',action='store',type=float,dest='latency',default=0.0,
+        help="Specify the seconds taken by each fake API call (default 0)")
+    parser.add_argument('--throttle',action='store',type=float,dest='throttle',default=0.0,
+        help="Specify the proportion of fake API calls that are throttled (default 0)")
+    parser.add_argument('-p','--page-size',action='store',type=int,dest='pageSize',default=reaper.PAGESIZE,
+        help="Specify the number of instances in each page from the fake backend (default %d)"%reaper.PAGESIZE)
+    parser.add_argument('--batch-size',action='store',type=int,dest='batchSize',default=reaper.BATCHSIZE,
+        help="Specify the number of instances in each fake action call (default %d)"%reaper.BATCHSIZE)
+    parser.add_argument('--in-flight',action='store',type=int,dest='inFlight',default=reaper.INFLIGHT,
+        help="Specify the number of fake action calls in progress at the same time (default %d)"%reaper.INFLIGHT)
+    parser.add_argument('--api-rate',action='store',type=float,dest='apiRate',default=1000000.0,
+        help="Specify the number of fake API calls per second allowed by the scheduler (default unlimited)")
+    parser.add_argument('-r','--runs',action='store',type=int,dest='runs',default=10,
+        help="Specify the number of runs for the startup benchmark (default 10)")
+    parser.add_argument('-w','--wrap',action='store',type=int,dest='wrap',default=100000,
+        help="Specify the number of instances for the wrapping benchmark (default 100000)")
+    parser.add_argument('-e','--excludes',action='store',type=int,dest='excludes',default=400,
+        help="Specify the number of exclude filters (default 400)")
+    return parser.parse_args(args)
+
+if __name__ == "__main__":
+    args=arguments(sys.argv[1:])
+    benchmarks=args.benchmarks or ['startup','wrap','filter','pipeline']
+    if 'startup' in benchmarks:
+        benchmarkStartup(args.runs)
+    if 'wrap' in benchmarks:
+        benchmarkWrap(args.wrap)
+    if 'filter' in benchmarks:
+        for count in args.counts or [1000,10000]:
+            benchmarkFilters(count,args.excludes)
+    if 'pipeline' in benchmarks:
+        for count in args.sizes or [1000,10000,100000]:
+            benchmarkPipeline(count,args.tags,args.mix,args.latency,args.throttle,args.pageSize,args.batchSize,args.inFlight,args.apiRate)
@@ -4,25 +4,101 @@
 # (c) 2013 Ben Last <ben@benlast.com>
 
 #Standard modules
-import os, sys, argparse, types, re
-
-#We use distutils.version to check versions of libraries
-import distutils.version
-
-#Import boto and check the version
-BOTOVERSION='2.3.0'
-import boto
-if distutils.version.LooseVersion(boto.__version__) < distutils.version.LooseVersion(BOTOVERSION):
-    raise RuntimeError("The minimum required version of the boto module is %s" % BOTOVERSION)
-
-import boto.utils
-import boto.ec2
+import os, sys, argparse, types, re, time, threading, Queue, collections, sqlite3, json, tempfile, math, random, shlex, csv, StringIO
+import multiprocessing, calendar, contextlib, hashlib
+
+#boto is imported (and its version checked) by botoModule, only when it's first needed, so that
+#test runs, --help and argument errors start quickly.  Paging through DescribeInstances needs the max_results
+#and next_token arguments of get_all_reservations, which boto has had since 2.32.0.
+BOTOVERSION='2.32.0'
+BOTO=None
+BOTOLOCK=threading.Lock()
+
+def botoModule():
+    """Import boto and the submodules that we use the first time this is called, check that the version
+    is at least BOTOVERSION, and return the boto module."""
+    global BOTO
+    with BOTOLOCK:
+        if BOTO is None:
+            #We use distutils.version to check versions of libraries
+            import distutils.version
+            import boto, boto.utils, boto.ec2, boto.provider, boto.sts
+            if distutils.version.LooseVersion(boto.__version__) < distutils.version.LooseVersion(BOTOVERSION):
+                raise RuntimeError("The minimum required version of the boto module is %s" % BOTOVERSION)
+            BOTO=boto
+        return BOTO
 
 #Check for test mode - if we are in test mode, we stub out certain functions and run self-tests
 TESTMODE=("--test" in sys.argv)
 if TESTMODE:
     print "Running in test mode"
 
+#The number of instances requested per DescribeInstances call, and the range of page sizes that
+#the API will accept.
+PAGESIZE=1000
+MINPAGESIZE=5
+MAXPAGESIZE=1000
+
+#The default maximum number of regions that are scanned at the same time
+REGIONTHREADS=4
+
+#The default maximum number of instance ids sent in a single start/stop/terminate call
+BATCHSIZE=100
+
+#Exact-match keywords that map directly onto DescribeInstances filter names.  Tag filters are
+#handled separately, because EC2 tag keys are case-sensitive and ours are not.
+APIFILTERS={"id":"instance-id","state":"instance-state-name","instance_type":"instance-type",
+    "vpc_id":"vpc-id","subnet_id":"subnet-id"}
+
+#The default inventory cache file, and the default number of seconds that a cached inventory is used
+CACHEFILE=os.path.expanduser("~/.reaper-cache.sqlite")
+CACHETTL=300
+
+#The types of attribute value that are kept in the inventory cache
+CACHETYPES=(types.StringType,types.UnicodeType,types.IntType,types.LongType,types.FloatType,types.BooleanType,types.NoneType)
+
+#The attributes of boto instances that are properties rather than entries in the instance dict, which
+#are kept in the inventory cache along with the others
+CACHEPROPERTIES=("state","state_code","previous_state","previous_state_code","placement","placement_group","placement_tenancy")
+
+#The default number of action calls that may be in progress at the same time
+INFLIGHT=1
+
+#API call scheduling: the sustained rate (calls per second) and burst size of the token bucket, the
+#maximum number of calls in progress at once, and the retries and backoff (in seconds) on throttling
+APIRATE=20.0
+APIBURST=40
+APICONCURRENCY=8
+APIRETRIES=8
+APIBACKOFF=0.5
+APIMAXBACKOFF=30.0
+
+#The error codes with which EC2 reports that a call has been throttled
+THROTTLECODES=("RequestLimitExceeded","Throttling","ThrottlingException")
+
+#The error codes with which EC2 rejects a whole action call because of particular instances in it
+REJECTIONCODES=("IncorrectInstanceState","InvalidInstanceID.NotFound","InvalidInstanceID.Malformed")
+
+#Waiting for actions to take effect: the default timeout and polling interval in seconds, and the
+#number of instance ids whose states are fetched by each call
+WAITTIMEOUT=600.0
+WAITINTERVAL=5.0
+WAITCHUNK=200
+
+#The output formats for listed instances, and the fields written by the structured formats by default
+OUTPUTFORMATS=("text","jsonl","csv")
+OUTPUTFIELDS=("id","tags.name","state","region")
+
+#Scanning several accounts: the default number of processes that scan (account,region) pairs at the same
+#time, the session name used when assuming each account's role, and the number of seconds before an
+#assumed-role session expires that it is replaced
+ACCOUNTPROCESSES=8
+SESSIONNAME="reaper"
+SESSIONMARGIN=300
+
+#The region used in test mode when all regions are requested
+TESTREGIONS=['ap-southeast-2']
+
 #A keyword=value splitter that takes a string and returns a 2-tuple or raises
 #an exception if there's a format error.
 def splitKV(arg):
@@ -38,6 +114,11 @@ def splitKV(arg):
 
     return (k,v)
 
+def splitList(arg):
+    """Split a comma-separated list of values, strip each one and return a list of the
+    non-empty values."""
+    return [v.strip() for v in arg.split(',') if v.strip()]
+
 class FilterAction(argparse.Action):
     """An argument parsing action for argparse that will store an include or exclude filter
     as a (keyword,value,isRegex) tuple, appending it to the appropriate attribute."""
@@ -64,11 +145,45 @@ class FilterAction(argparse.Action):
             #Append to the appropriate existing list of (k,v,isRegex) tuples
             setattr(namespace,attr,getattr(namespace,attr,[])+[(k,v,isRegex)])
 
+def addFilterArguments(parser):
+    """Add the include and exclude filter options to the given parser."""
+    parser.add_argument(*FilterAction.INCLUDETAGS,
+        action=FilterAction,type=splitKV,dest='includes',default=[],
+        help="Specify a simple inclusion filter (a keyword=value option where the value must match, including case)")
+
+    parser.add_argument(*FilterAction.EXCLUDETAGS,action=FilterAction,type=splitKV,dest='excludes',default=[],
+        help="Specify a simple exclusion filter (a keyword=value option where the value must match, including case)")
+
+    parser.add_argument(*FilterAction.INCLUDERTAGS,action=FilterAction,type=splitKV,dest='includes',default=[],
+        help="Specify a regex inclusion filter (a keyword=value option where the value is a regular expression)")
+
+    parser.add_argument(*FilterAction.EXCLUDERTAGS,action=FilterAction,type=splitKV,dest='excludes',default=[],
+        help="Specify a regex exclusion filter (a keyword=value option where the value is a regular expression)")
+
+def addActionArguments(parser):
+    """Add the action options to the given parser."""
+    parser.add_argument('--start',action='store_const',const='start',dest='action')
+    parser.add_argument('--stop',action='store_const',const='stop',dest='action')
+    parser.add_argument('--terminate',action='store_const',const='terminate',dest='action')
+
+class RuleParser(argparse.ArgumentParser):
+    """An argument parser for a line of a rules file, which raises ValueError instead of exiting."""
+    def error(self,message):
+        raise ValueError(message)
+
+def ruleArguments(args):
+    """Parse the options for a single rule (filters and an action) and return the result of parsing."""
+    parser=RuleParser(add_help=False)
+    addFilterArguments(parser)
+    addActionArguments(parser)
+    return parser.parse_args(args)
+
 def arguments(args=sys.argv[1:]):
     """Parse command line arguments and return the result of parsing."""
     parser=argparse.ArgumentParser(usage="""\
 This program will identify all EC2 instances in the specified region (or the same region as this
-instance, if running in EC2).  Filters may be used to include only some instances, or to
+instance, if running in EC2).  Several regions may be given as a comma-separated list, or 'all' for
+every region; these are scanned at the same time.  Filters may be used to include only some instances, or to
 exclude some instances.  Filters operate by looking at the values of certain instance
 attributes: specifically, those returned by the Python boto library for EC2 instances.
 
@@ -89,89 +204,186 @@ The rules for matching are:
 If you specify --start, --stop or --terminate, then this action is applied to all the selected
 instances.
 If you don't specify any of --start, --stop or --terminate, then the instances are listed but
-no action is taken.
+no action is taken.  With --output jsonl or --output csv, each listed instance is written as a row
+of just the fields given with --fields (for example: --fields id,state,tags.owner,launch_time).
+
+With --accounts, each of the accounts is reached by assuming the given role, and every region is
+scanned in every account.  The accounts are scanned at the same time by a pool of processes, and
+the instances from all of them are filtered and acted on together.  Each listed instance shows its
+account id.
+
+A rules file (--rules) holds one rule per line, written with the same filter and action options
+as the command line (for example: --stop -i tags.env=dev).  Blank lines and lines starting with #
+are ignored.  Every instance is checked against every rule, and if more than one rule matches, the
+strongest action wins: terminate, then stop, then start, then listing.  Between rules with the same
+action, the first in the file wins.
 """)
 
-    parser.add_argument(*FilterAction.INCLUDETAGS,
-        action=FilterAction,type=splitKV,dest='includes',default=[],
-        help="Specify a simple inclusion filter (a keyword=value option where the value must match, including case)")
+    addFilterArguments(parser)
 
-    parser.add_argument(*FilterAction.EXCLUDETAGS,action=FilterAction,type=splitKV,dest='excludes',default=[],
-        help="Specify a simple exclusion filter (a keyword=value option where the value must match, including case)")
+    parser.add_argument('-r','--region',action='store',type=splitList,dest='region',
+        help="Specify the region to be scanned, a comma-separated list of regions, or 'all' for every region")
 
-    parser.add_argument(*FilterAction.INCLUDERTAGS,action=FilterAction,type=splitKV,dest='includes',default=[],
-        help="Specify a regex inclusion filter (a keyword=value option where the value is a regular expression)")
+    parser.add_argument('--accounts',action='store',type=splitList,dest='accounts',metavar='ROLES',
+        help="Scan every region given in each of the accounts whose IAM roles are given as a comma-separated list of role ARNs")
 
-    parser.add_argument(*FilterAction.EXCLUDERTAGS,action=FilterAction,type=splitKV,dest='excludes',default=[],
-        help="Specify a regex exclusion filter (a keyword=value option where the value is a regular expression)")
+    parser.add_argument('--processes',action='store',type=int,dest='processes',default=ACCOUNTPROCESSES,
+        help="Specify the maximum number of (account,region) pairs scanned at the same time with --accounts (default %d)"%ACCOUNTPROCESSES)
 
-    parser.add_argument('-r','--region',action='store',dest='region',
-        help="Specify the region to be scanned")
+    parser.add_argument('--region-threads',action='store',type=int,dest='regionThreads',default=REGIONTHREADS,
+        help="Specify the maximum number of regions scanned at the same time (default %d)"%REGIONTHREADS)
 
-    parser.add_argument('--start',action='store_const',const='start',dest='action')
-    parser.add_argument('--stop',action='store_const',const='stop',dest='action')
-    parser.add_argument('--terminate',action='store_const',const='terminate',dest='action')
+    parser.add_argument('--page-size',action='store',type=int,dest='pageSize',default=PAGESIZE,
+        help="Specify the number of instances fetched per API call (%d to %d, default %d)"%(MINPAGESIZE,MAXPAGESIZE,PAGESIZE))
+
+    addActionArguments(parser)
+
+    parser.add_argument('--rules',action='store',dest='rules',metavar='FILE',
+        help="Apply the rules in FILE, each with its own filters and action, in a single scan.  Any filters given on "
+            "the command line apply to every rule.")
+
+    parser.add_argument('--cache',action='store',nargs='?',const=CACHEFILE,dest='cache',
+        help="Use an inventory cache file (default %s), so that repeated runs need not scan again"%CACHEFILE)
+
+    parser.add_argument('--cache-ttl',action='store',type=int,dest='cacheTtl',default=CACHETTL,
+        help="Specify the number of seconds that a cached inventory is used for (default %d)"%CACHETTL)
+
+    parser.add_argument('--refresh',action='store_true',dest='refresh',default=False,
+        help="Scan again and update the inventory cache even if it's still fresh")
+
+    parser.add_argument('--in-flight',action='store',type=int,dest='inFlight',default=INFLIGHT,
+        help="Specify the number of action calls that may be in progress at the same time (default %d).  "
+            "With more than one, actions are sent by worker threads while scanning and filtering carry on."%INFLIGHT)
+
+    parser.add_argument('--api-rate',action='store',type=float,dest='apiRate',default=APIRATE,
+        help="Specify the sustained number of API calls per second (default %s)"%APIRATE)
+
+    parser.add_argument('--api-burst',action='store',type=int,dest='apiBurst',default=APIBURST,
+        help="Specify the number of API calls that may be made at once before the rate applies (default %d)"%APIBURST)
+
+    parser.add_argument('--api-concurrency',action='store',type=int,dest='apiConcurrency',default=APICONCURRENCY,
+        help="Specify the most API calls in progress at the same time, which is reduced while calls are throttled (default %d)"%APICONCURRENCY)
+
+    parser.add_argument('--api-retries',action='store',type=int,dest='apiRetries',default=APIRETRIES,
+        help="Specify the number of times a throttled API call is retried (default %d)"%APIRETRIES)
+
+    parser.add_argument('--wait',action='store',nargs='?',type=float,const=WAITTIMEOUT,dest='wait',metavar='TIMEOUT',
+        help="After acting, wait up to TIMEOUT seconds (default %d) for the instances to reach their new state, "
+            "then summarize those that did, are still pending, or failed"%WAITTIMEOUT)
+
+    parser.add_argument('--wait-interval',action='store',type=float,dest='waitInterval',default=WAITINTERVAL,
+        help="Specify the seconds between polls of instance states when waiting (default %d)"%WAITINTERVAL)
+
+    parser.add_argument('--plan',action='store',dest='plan',metavar='FILE',
+        help="Instead of acting, write the instances that would be acted on, with their actions and current states, to FILE")
+
+    parser.add_argument('--apply',action='store',dest='apply',metavar='FILE',
+        help="Apply the plan in FILE (written by --plan) without scanning, skipping any instance whose state has changed")
+
+    parser.add_argument('--watch',action='store',type=float,dest='watch',metavar='INTERVAL',
+        help="Keep running, scanning again every INTERVAL seconds, and only consider instances that are new or changed since the last scan")
+
+    parser.add_argument('--batch-size',action='store',type=int,dest='batchSize',default=BATCHSIZE,
+        help="Specify the maximum number of instances acted on by a single API call (default %d)"%BATCHSIZE)
+
+    parser.add_argument('--output',action='store',dest='output',choices=OUTPUTFORMATS,default='text',
+        help="Specify the format in which instances are listed: text (the default), jsonl (a JSON object per line) or csv")
+
+    parser.add_argument('--fields',action='store',type=splitList,dest='fields',
+        help="Specify a comma-separated list of the fields written by --output jsonl or csv: attribute names, or "
+            "tags.<tagname> for tags (default %s)"%",".join(OUTPUTFIELDS))
+
+    parser.add_argument('--stats',action='store',dest='stats',metavar='FILE',
+        help="Write statistics for the run (phase times, API calls and latencies, instance counts) to FILE, or '-' for stdout")
+
+    parser.add_argument('--stats-format',action='store',dest='statsFormat',choices=['json','prometheus'],default='json',
+        help="Specify the format of the statistics: json (the default) or prometheus (for a node exporter textfile)")
 
     parser.add_argument('-v','--verbose',action='count',dest='verbose',default=0,
         help="Increase verbosity of output")
 
     return parser.parse_args(args)
 
-class Instance:
+class Instance(object):
     """This class represents the information for an instance, in a form that is easily filterable.  We
     use a class of our own to wrap actual instance objects so that we can mock up test data easily, built
-    from string representations of actual instance data."""
-    def __init__(self,data):
+    from string representations of actual instance data.
+    To keep large inventories small and quick to build, only the attributes in FIELDS (and any others
+    named when the Instance is created) are copied from the underlying object.  Any other attribute is
+    looked up on the underlying object the first time it's used, and kept from then on."""
+
+    #The attributes that are always copied from the underlying object, because they're needed for
+    #output and actions.
+    FIELDS=("id","state","tags","region","account")
+    __slots__=FIELDS+("instance","_extra")
+
+    def __init__(self,data,fields=()):
         """Initialize either from a boto.ec2.instance.Instance or a dict: the latter may be used in
-        test mode to create fake Instances."""
-        if type(data) in [types.DictType,types.DictionaryType]:
-            #Fake up from a string - eval the string to get a dict and then set the attributes of this object
-            #from the dict.
-            for (k,v) in data.iteritems():
-                setattr(self,k,v)
-        else:
-            #We'll assume it's a boto.ec2.instance.Instance, and set attributes on self for every
-            #non-builtin attribute in the object.
-            map(lambda (k,v): setattr(self,k,v),((k,v) for (k,v) in data.__dict__.iteritems() if not k.startswith('__')))
-            #Copy the bound control methods from the original object, replacing the test methods
-            self.start=data.start
-            self.stop=data.stop
-            self.terminate=data.terminate
-
-        if not hasattr(self,"tags"):
+        test mode to create fake Instances.  The fields argument names any attributes, in addition to
+        FIELDS, that should be copied now rather than on first use (such as those used by filters)."""
+        # Store the underlying object
+        self.instance=data
+        self._extra=None
+        for name in Instance.FIELDS:
+            try:
+                setattr(self,name,self.lookup(name))
+            except AttributeError:
+                pass
+        for name in fields:
+            if name not in Instance.__slots__:
+                try:
+                    getattr(self,name)
+                except AttributeError:
+                    pass
+
+        if getattr(self,"tags",None) is None:
             self.tags={}
         else:
             #Rewrite the dict to have lower-case keys
             self.tags=dict([(a.lower(),b) for (a,b) in self.tags.iteritems()])
 
-        # Store the underlying object
-        self.instance=data
+    def lookup(self,name):
+        """Return the value of the named attribute of the underlying object, or raise AttributeError."""
+        data=self.instance
+        if type(data) in [types.DictType,types.DictionaryType]:
+            try:
+                return data[name]
+            except KeyError:
+                raise AttributeError(name)
+        return getattr(data,name)
+
+    def __getattr__(self,name):
+        """Called for any attribute that isn't set on this object: look it up on the underlying object,
+        and keep the value for next time."""
+        if name.startswith('__') or name in Instance.__slots__:
+            raise AttributeError(name)
+        extra=self._extra
+        if extra is not None and name in extra:
+            return extra[name]
+        value=self.lookup(name)
+        if extra is None:
+            self._extra=extra={}
+        extra[name]=value
+        return value
 
     def __unicode__(self):
-        return u"id:%s name:'%s' State:%s"% (getattr(self,"id",u"(no id)"),
+        account=getattr(self,"account",None)
+        return u"id:%s name:'%s' State:%s Region:%s%s"% (getattr(self,"id",u"(no id)"),
             self.tags.get("name",u"(no name)"),
-            getattr(self,"state",u"(no state)"))
+            getattr(self,"state",u"(no state)"),
+            getattr(self,"region",u"(no region)"),
+            u" Account:%s"%account if account is not None else u"")
 
     def __str__(self):
         return unicode(self).encode('utf-8')
 
-    def start(self):
-        """Test mode implementation - sets state value"""
-        self.state="started"
-
-    def stop(self):
-        """Test mode implementation - sets state value"""
-        self.state="stopped"
+    def isTest(self):
+        """Return True if this Instance was created from a data dict rather than a boto instance."""
+        return type(self.instance) in [types.DictType,types.DictionaryType]
 
-    def terminate(self):
-        """Test mode implementation - sets state value"""
-        self.state="terminated"
-
-def getAllInstances(region=None):
-    """A generator that will yield an Instance for every instance found."""
-    if TESTMODE:
-        #Fake up a set of Instances
-        testData="""[\
+#Test data, used in test mode instead of fetching instances from the API.  This is a string
+#representation of real instance data, and evals to a list of dicts.
+TESTDATA="""[\
 {'kernel': u'aki-31990e0b', 'root_device_type': u'ebs', 'private_dns_name': u'ip-172-31-22-97.ap-southeast-2.compute.internal',
 'instanceState': u'\\n                    ', 'previous_state': None, 'public_dns_name': '', 'id': u'i-e48f12d9', 'deviceIndex': u'0',
 'state_reason': {u'message': u'Client.UserInitiatedShutdown: User initiated shutdown', u'code': u'Client.UserInitiatedShutdown'},
@@ -235,15 +447,919 @@ def getAllInstances(region=None):
 'status': u'attached', 'root_device_name': u'/dev/sda1', 'hypervisor': u'xen',
 'private_ip_address': u'172.31.22.99', 'vpc_id': u'vpc-09eb5160', 'product_codes': [], 'networkInterfaceId': u'eni-754e0a1c'}
 ]"""
-        #testData evals to a list of dicts, and we will yield an Instance for each dict
-        for data in eval(testData):
-            yield Instance(data)
+
+def matchesApiFilters(data,apiFilters):
+    """Local implementation of DescribeInstances filtering, used for test data and cached inventories:
+    return True if the given instance data dict matches all of the given API filters."""
+    keywords=dict((v,k) for (k,v) in APIFILTERS.iteritems())
+    for (name,values) in apiFilters.iteritems():
+        if name=="tag-value":
+            if not any(v in values for v in data.get("tags",{}).itervalues()):
+                return False
+        elif data.get(keywords[name]) not in values:
+            return False
+    return True
+
+class Stats:
+    """Collects statistics for a run: the wall time spent in each phase, the latency of every API call
+    (by operation), and counts of instances.  It may be used from several threads.  Timing of the
+    per-instance phases (such as filtering) costs a little, so it's only done when enabled is set.
+    With --watch, the statistics are reset at the start of each scan, so every report covers one scan."""
+
+    #The latency percentiles that are reported for each API operation
+    PERCENTILES=(50,90,99)
+
+    def __init__(self):
+        self.lock=threading.Lock()
+        self.enabled=False
+        self.reset()
+
+    def reset(self):
+        """Discard everything collected so far and start again, as at the start of each scan with --watch."""
+        with self.lock:
+            self.started=time.time()
+            self.phases=collections.defaultdict(float)
+            self.calls=collections.defaultdict(list)
+            self.throttles=collections.defaultdict(int)
+            self.counts=collections.defaultdict(int)
+
+    def phase(self,name,seconds):
+        """Add seconds to the time spent in the named phase."""
+        with self.lock:
+            self.phases[name]+=seconds
+
+    def call(self,operation,seconds,throttled=False):
+        """Record one API call of the given operation, which took seconds and may have been throttled."""
+        with self.lock:
+            self.calls[operation].append(seconds)
+            if throttled:
+                self.throttles[operation]+=1
+
+    def merge(self,calls,throttles):
+        """Add the API call latencies and throttle counts (as kept in calls and throttles) from another process."""
+        with self.lock:
+            for (operation,latencies) in calls.iteritems():
+                self.calls[operation].extend(latencies)
+            for (operation,n) in throttles.iteritems():
+                self.throttles[operation]+=n
+
+    def count(self,name,n=1):
+        """Add n to the named count."""
+        with self.lock:
+            self.counts[name]+=n
+
+    def counted(self,name,iterable):
+        """A generator that yields every item of iterable, adding one to the named count for each."""
+        for item in iterable:
+            self.count(name)
+            yield item
+
+    def timed(self,name,function):
+        """Return a function that calls function, adding the time it takes to the named phase."""
+        def timedFunction(*args):
+            started=time.time()
+            try:
+                return function(*args)
+            finally:
+                self.phase(name,time.time()-started)
+        return timedFunction
+
+    @staticmethod
+    def percentile(values,p):
+        """Return the p'th percentile (nearest rank) of the given sorted list of values."""
+        return values[max(0,min(len(values)-1,int(math.ceil(p/100.0*len(values)))-1))]
+
+    def report(self):
+        """Return the statistics as a dict."""
+        with self.lock:
+            calls={}
+            for (operation,latencies) in self.calls.iteritems():
+                latencies=sorted(latencies)
+                calls[operation]=dict([("count",len(latencies)),("seconds",sum(latencies)),("max",latencies[-1]),
+                    ("throttled",self.throttles.get(operation,0))]+
+                    [("p%d"%p,Stats.percentile(latencies,p)) for p in Stats.PERCENTILES])
+            phases=dict(self.phases)
+            phases["total"]=time.time()-self.started
+            return {"phases":phases,"calls":calls,"instances":dict(self.counts)}
+
+    def prometheus(self):
+        """Return the statistics in the Prometheus text exposition format, as used by textfiles."""
+        report=self.report()
+        lines=["# TYPE reaper_phase_seconds gauge"]
+        lines+=['reaper_phase_seconds{phase="%s"} %f'%(k,v) for (k,v) in sorted(report["phases"].items())]
+        lines.append("# TYPE reaper_instances gauge")
+        lines+=['reaper_instances{stage="%s"} %d'%(k,v) for (k,v) in sorted(report["instances"].items())]
+        lines.append("# TYPE reaper_api_calls gauge")
+        lines+=['reaper_api_calls{operation="%s"} %d'%(k,v["count"]) for (k,v) in sorted(report["calls"].items())]
+        lines.append("# TYPE reaper_api_throttles gauge")
+        lines+=['reaper_api_throttles{operation="%s"} %d'%(k,v["throttled"]) for (k,v) in sorted(report["calls"].items())]
+        lines.append("# TYPE reaper_api_latency_seconds summary")
+        for (operation,v) in sorted(report["calls"].items()):
+            lines+=['reaper_api_latency_seconds{operation="%s",quantile="%s"} %f'%(operation,p/100.0,v["p%d"%p]) for p in Stats.PERCENTILES]
+            lines.append('reaper_api_latency_seconds_sum{operation="%s"} %f'%(operation,v["seconds"]))
+            lines.append('reaper_api_latency_seconds_count{operation="%s"} %d'%(operation,v["count"]))
+        return "\n".join(lines)+"\n"
+
+    def write(self,path,format="json"):
+        """Write the statistics to the given file (or stdout, if path is '-') in json or prometheus
+        format.  Files are written to a temporary file and renamed, so a reader never sees a partial file."""
+        text=self.prometheus() if format=="prometheus" else json.dumps(self.report(),sort_keys=True)+"\n"
+        if path=="-":
+            sys.stdout.write(text)
+        else:
+            temporary="%s.%d.tmp"%(path,os.getpid())
+            with open(temporary,"w") as f:
+                f.write(text)
+            os.rename(temporary,path)
+
+#The statistics for this run
+STATS=Stats()
+
+def isThrottled(error):
+    """Return True if the given exception means that EC2 throttled the call."""
+    return getattr(error,"error_code",None) in THROTTLECODES
+
+class ThrottledError(Exception):
+    """Raised by a FakeBackend for a call that it throttles, with the error code that EC2 would give."""
+    error_code=THROTTLECODES[0]
+
+class RejectedError(Exception):
+    """Raised by a FakeBackend for a call that EC2 would reject as a whole, with the error code that EC2 would give."""
+    def __init__(self,code,message):
+        Exception.__init__(self,"%s: %s"%(code,message))
+        self.error_code=code
+
+class Scheduler:
+    """Every EC2 API call goes through a Scheduler, so that the calls from all threads together stay
+    within the account's API limits (which other tools share).  Calls take a token from a bucket that
+    holds up to burst tokens and refills at rate tokens per second.  No more than limit calls are in
+    progress at once: the limit is halved whenever a call is throttled, and raised by one (up to
+    concurrency) after limit calls in a row succeed.  A throttled call is retried up to retries times,
+    after a random delay of up to backoff*2**attempt seconds (capped at maxBackoff)."""
+    def __init__(self,rate=APIRATE,burst=APIBURST,concurrency=APICONCURRENCY,retries=APIRETRIES,
+            backoff=APIBACKOFF,maxBackoff=APIMAXBACKOFF,clock=time.time,sleep=time.sleep):
+        self.rate=float(rate)
+        self.burst=max(1,burst)
+        self.concurrency=max(1,concurrency)
+        self.retries=retries
+        self.backoff=backoff
+        self.maxBackoff=maxBackoff
+        #The clock and sleep functions may be replaced for testing
+        self.clock=clock
+        self.sleep=sleep
+        self.random=random.Random()
+        self.condition=threading.Condition()
+        self.tokens=float(self.burst)
+        self.updated=clock()
+        self.limit=self.concurrency
+        self.active=0
+        self.successes=0
+
+    def acquire(self):
+        """Wait for a free slot and a token."""
+        with self.condition:
+            while self.active>=self.limit:
+                self.condition.wait()
+            self.active+=1
+            now=self.clock()
+            self.tokens=min(self.burst,self.tokens+(now-self.updated)*self.rate)
+            self.updated=now
+            #Take the token now, even if the bucket is empty, and wait until it would have been added: this
+            #keeps the callers in order.
+            self.tokens-=1
+            wait=-self.tokens/self.rate if self.tokens<0 else 0
+        if wait:
+            self.sleep(wait)
+
+    def release(self,throttled):
+        """Free the slot taken by acquire, and adjust the limit on calls in progress."""
+        with self.condition:
+            self.active-=1
+            if throttled:
+                self.limit=max(1,self.limit//2)
+                self.successes=0
+            else:
+                self.successes+=1
+                if self.successes>=self.limit and self.limit<self.concurrency:
+                    self.limit+=1
+                    self.successes=0
+            self.condition.notify_all()
+
+    def call(self,operation,function,*args,**kwargs):
+        """Call function with args and kwargs as the named API operation, retrying if it's throttled, and
+        return its result.  Any other error (or running out of retries) raises the exception."""
+        attempt=0
+        while True:
+            self.acquire()
+            started=time.time()
+            try:
+                result=function(*args,**kwargs)
+            except Exception,e:
+                throttled=isThrottled(e)
+                self.release(throttled)
+                STATS.call(operation,time.time()-started,throttled)
+                if not throttled or attempt>=self.retries:
+                    raise
+                self.sleep(self.random.uniform(0,min(self.maxBackoff,self.backoff*2**attempt)))
+                attempt+=1
+                continue
+            self.release(False)
+            STATS.call(operation,time.time()-started)
+            return result
+
+#The scheduler for all API calls in this run
+SCHEDULER=Scheduler()
+
+#Connections to each region, kept so that later scans and actions can reuse them: an (access key,connection)
+#tuple for each (region,account) key, where the account is None for the default credentials
+CONNECTIONS={}
+CONNECTIONSLOCK=threading.Lock()
+
+def getConnection(region,credentials=None,account=None):
+    """Return the connection to the given region, creating it the first time that it's needed.  If
+    credentials is given, it is a dict of temporary credentials (as returned by assumeRole) for the
+    account with the given id, that the connection uses instead of the default credentials.  There is
+    one connection for each account and region: when an account's session is replaced, so is the
+    connection, so a long --watch run keeps no more connections than it uses."""
+    key=(region,account if credentials else None)
+    accessKey=credentials["access_key"] if credentials else None
+    with CONNECTIONSLOCK:
+        (kept,connection)=CONNECTIONS.get(key,(None,None))
+        if connection is None or kept!=accessKey:
+            if credentials:
+                connection=botoModule().ec2.connect_to_region(region,aws_access_key_id=credentials["access_key"],
+                    aws_secret_access_key=credentials["secret_key"],security_token=credentials["session_token"])
+            else:
+                connection=botoModule().ec2.connect_to_region(region)
+            if connection is None:
+                raise ValueError("Unknown region %s"%region)
+            CONNECTIONS[key]=(accessKey,connection)
+        return connection
+
+def callerAccount():
+    """Return the id of the account that the default credentials belong to, from the STS GetCallerIdentity
+    call (which boto 2 has no method for)."""
+    sts=botoModule().sts.STSConnection()
+    response=SCHEDULER.call("GetCallerIdentity",sts.make_request,"GetCallerIdentity",{},"/","POST")
+    body=response.read()
+    match=re.search(r"<Account>(\d+)</Account>",body)
+    if response.status!=200 or match is None:
+        raise RuntimeError("Can't find the account id (%s %s): %s"%(response.status,response.reason,body))
+    return match.group(1)
+
+def accountId(arn):
+    """Return the account id from an IAM role ARN (arn:aws:iam::<account>:role/<name>), or raise ValueError."""
+    parts=arn.split(':')
+    if len(parts)<6 or parts[0]!="arn" or not parts[4].isdigit():
+        raise ValueError("%s is not a role ARN"%arn)
+    return parts[4]
+
+def assumeRole(arn):
+    """Assume the IAM role with the given ARN and return its temporary credentials as a dict of access_key,
+    secret_key, session_token and expiration (in seconds since the epoch)."""
+    boto=botoModule()
+    role=SCHEDULER.call("AssumeRole",boto.sts.STSConnection().assume_role,arn,SESSIONNAME)
+    c=role.credentials
+    return {"access_key":c.access_key,"secret_key":c.secret_key,"session_token":c.session_token,
+        "expiration":calendar.timegm(boto.utils.parse_ts(c.expiration).timetuple())}
+
+class Sessions:
+    """Keeps the temporary credentials for each assumed role until margin seconds before they expire, so
+    that later scans (with --watch) don't need to assume the roles again.  The assume function, if given,
+    is used instead of assumeRole.  It may be used from several threads."""
+    def __init__(self,margin=SESSIONMARGIN,assume=None,clock=time.time):
+        self.margin=margin
+        self.assume=assume or assumeRole
+        self.clock=clock
+        self.lock=threading.Lock()
+        #The credentials for each role, keyed by ARN
+        self.sessions={}
+
+    def get(self,arn):
+        """Return the credentials for the role with the given ARN, assuming it if there's no fresh session."""
+        with self.lock:
+            session=self.sessions.get(arn)
+        if session is None or session["expiration"]-self.margin<=self.clock():
+            session=self.assume(arn)
+            with self.lock:
+                self.sessions[arn]=session
+        return session
+
+#The assumed-role sessions for this run
+SESSIONS=Sessions()
+
+class Backend:
+    """The interface through which instances are found and acted on.  A backend enumerates the instances
+    in a region a page at a time, looks up the current state of instances by id, and applies actions to
+    instances in bulk.  Every call that a backend makes to EC2 (real or simulated) goes through SCHEDULER."""
+
+    def regions(self):
+        """Return the names of all the regions, for when 'all' are asked for."""
+        raise NotImplementedError()
+
+    def account(self):
+        """Return the key that identifies the AWS account."""
+        raise NotImplementedError()
+
+    def accessKey(self):
+        """Return the access key id of the credentials that the backend uses, or None if it has none.  The
+        inventory cache uses it to find the account without calling account() (see accountKey)."""
+        return None
+
+    def pages(self,region,pageSize=PAGESIZE,apiFilters=None,fields=()):
+        """A generator that will yield a list of Instances for each page of instances in the region.  If
+        apiFilters is given, it is a dict of DescribeInstances filters (as returned by planFilters) that is
+        applied by the backend.  The fields argument is passed to each Instance."""
+        raise NotImplementedError()
+
+    def instances(self,region,ids,fields=()):
+        """Return a list of the Instances with the given ids in the region, as they are now.  Ids that
+        aren't found are left out."""
+        return [i for page in self.pages(region,PAGESIZE,{"instance-id":ids},fields) for i in page]
+
+    def act(self,action,region,ids):
+        """Apply the action (start, stop or terminate) to the instances with the given ids in the region
+        in a single call, and return the list of the ids whose state changed.  Raise an exception if
+        the call fails."""
+        raise NotImplementedError()
+
+    def forAccount(self,arn):
+        """Return a backend of the same kind for the account of the IAM role with the given ARN, reached
+        by assuming that role.  Its account method returns the account id."""
+        raise NotImplementedError()
+
+class BotoBackend(Backend):
+    """The EC2 API, reached through boto, with a connection to each region kept in CONNECTIONS.  If
+    credentials is given, it is a dict of temporary credentials for the account with id accountId."""
+
+    def __init__(self,credentials=None,accountId=None):
+        self.credentials=credentials
+        self.accountId=accountId
+
+    def regions(self):
+        return [r.name for r in botoModule().ec2.regions()]
+
+    def account(self):
+        if self.accountId is None:
+            self.accountId=callerAccount()
+        return self.accountId
+
+    def accessKey(self):
+        if self.credentials:
+            return self.credentials["access_key"]
+        return botoModule().provider.Provider('aws').access_key
+
+    def forAccount(self,arn):
+        """The role's session is kept in SESSIONS until it's about to expire."""
+        return BotoBackend(SESSIONS.get(arn),accountId(arn))
+
+    def pages(self,region,pageSize=PAGESIZE,apiFilters=None,fields=()):
+        """Pages are fetched one at a time, following the NextToken returned with each page, so that only
+        about one page of instances is held in memory at once."""
+        #Each page is a list of reservations, each of which contains a list of instances.  We
+        #flatten those into a single list of Instances per page.
+        connection=getConnection(region,self.credentials,self.accountId)
+        #The API will only accept a page size in the range MINPAGESIZE..MAXPAGESIZE
+        pageSize=max(MINPAGESIZE,min(MAXPAGESIZE,pageSize))
+        nextToken=None
+        while True:
+            reservations=SCHEDULER.call("DescribeInstances",connection.get_all_reservations,
+                filters=apiFilters or None,max_results=pageSize,next_token=nextToken)
+            started=time.time()
+            page=[Instance(instance,fields) for r in reservations for instance in r.instances]
+            STATS.phase("wrap",time.time()-started)
+            yield page
+            nextToken=reservations.next_token
+            if not nextToken:
+                break
+
+    def act(self,action,region,ids):
+        connection=getConnection(region,self.credentials,self.accountId)
+        #The call returns the instances whose state changed
+        changed=SCHEDULER.call("%sInstances"%action.capitalize(),getattr(connection,"%s_instances"%action),instance_ids=ids)
+        return [c.id for c in changed]
+
+class FakeBackend(Backend):
+    """An in-memory stand-in for EC2, used in test mode and for load tests without a network.  The fleet
+    is given by data, either a list of instance data dicts or a function that returns the data dict for
+    instance number n (of count), so that a large fleet never needs to be held in memory.  Every region
+    holds its own copy of the fleet.
+    Actions move an instance into a transitional state (such as stopping), and it reaches the target
+    state transition seconds later.  An action call that names an unknown instance, or one in the wrong
+    state, is rejected as a whole, as it is by EC2.  Only the states of instances that have been acted on are kept.
+    Every call takes latency seconds, and a random fraction throttle of calls are throttled with a
+    ThrottledError, as EC2 would.  Pages are split like those of the API, but any page size is allowed.
+    The clock, sleep and seed arguments may be given for repeatable tests."""
+
+    #The transitional and target states for each action, and the states that each action may be applied to
+    TRANSITIONS={"start":("pending","running"),"stop":("stopping","stopped"),"terminate":("shutting-down","terminated")}
+    FROM={"start":("stopped",),"stop":("pending","running"),
+        "terminate":("pending","running","stopping","stopped","shutting-down")}
+
+    def __init__(self,data,count=None,regions=TESTREGIONS,account="test",latency=0.0,throttle=0.0,transition=0.0,
+            clock=time.time,sleep=time.sleep,seed=None):
+        if callable(data):
+            (self.make,self.count)=(data,count)
+        else:
+            (self.make,self.count)=(lambda n: dict(data[n]),len(data))
+        self.regionNames=list(regions)
+        self.accountKey=account
+        self.latency=latency
+        self.throttle=throttle
+        self.transition=transition
+        self.clock=clock
+        self.sleep=sleep
+        self.random=random.Random(seed)
+        self.lock=threading.Lock()
+        #The number of each instance, keyed by id (built when first needed), and the (transitional,
+        #until,target) state of each instance that has been acted on, keyed by (region,id)
+        self.numbers=None
+        self.changes={}
+        self.calls=0
+        #The FakeBackend for each other account, keyed by account id
+        self.accounts={}
+
+    def regions(self):
+        return self.regionNames
+
+    def account(self):
+        return self.accountKey
+
+    def request(self):
+        """Simulate the latency and throttling of an API call."""
+        with self.lock:
+            self.calls+=1
+            throttled=self.throttle and self.random.random()<self.throttle
+        if self.latency:
+            self.sleep(self.latency)
+        if throttled:
+            raise ThrottledError("Request limit exceeded (simulated)")
+
+    def index(self):
+        """Return a dict of the number of each instance, keyed by id."""
+        with self.lock:
+            if self.numbers is None:
+                self.numbers=dict((self.make(n)["id"],n) for n in xrange(self.count))
+            return self.numbers
+
+    def state(self,region,id,state):
+        """Return the current state of the instance with the given id in the region, whose state in the
+        fleet data is state."""
+        change=self.changes.get((region,id))
+        if change is None:
+            return state
+        (transitional,until,target)=change
+        return target if self.clock()>=until else transitional
+
+    def record(self,region,n):
+        """Return the data dict for instance number n in the region as it is now."""
+        data=self.make(n)
+        data["state"]=self.state(region,data["id"],data.get("state"))
+        return data
+
+    def describe(self,region,token,pageSize,apiFilters):
+        """A single DescribeInstances call: return a (data,token) tuple of the list of data dicts for the
+        page that starts at token (a position in the fleet), and the token for the next page or None."""
+        self.request()
+        ids=(apiFilters or {}).get("instance-id")
+        if ids is not None:
+            index=self.index()
+            numbers=sorted(index[i] for i in set(ids) if i in index)
+        else:
+            numbers=xrange(self.count)
+        data=[]
+        while token<len(numbers) and len(data)<pageSize:
+            d=self.record(region,numbers[token])
+            token+=1
+            if matchesApiFilters(d,apiFilters or {}):
+                data.append(d)
+        return (data,token if token<len(numbers) else None)
+
+    def pages(self,region,pageSize=PAGESIZE,apiFilters=None,fields=()):
+        token=0
+        while token is not None:
+            (data,token)=SCHEDULER.call("DescribeInstances",self.describe,region,token,max(1,pageSize),apiFilters)
+            started=time.time()
+            page=[Instance(d,fields) for d in data]
+            STATS.phase("wrap",time.time()-started)
+            yield page
+
+    def change(self,action,region,ids):
+        """A single start, stop or terminate call: return the ids whose state changed.  As with EC2, if
+        any id is unknown or in a state that the action can't be applied to, nothing is changed and the
+        whole call fails with a RejectedError."""
+        self.request()
+        (transitional,target)=FakeBackend.TRANSITIONS[action]
+        index=self.index()
+        with self.lock:
+            unknown=[id for id in ids if id not in index]
+            if unknown:
+                raise RejectedError("InvalidInstanceID.NotFound","The instance IDs '%s' do not exist"%", ".join(unknown))
+            for id in ids:
+                state=self.state(region,id,self.make(index[id]).get("state"))
+                if state not in FakeBackend.FROM[action]:
+                    raise RejectedError("IncorrectInstanceState","The instance '%s' is not in a state from which it can be %s"%(
+                        id,{"start":"started","stop":"stopped","terminate":"terminated"}[action]))
+            until=self.clock()+self.transition
+            for id in ids:
+                self.changes[(region,id)]=(transitional,until,target)
+        return list(ids)
+
+    def act(self,action,region,ids):
+        return SCHEDULER.call("%sInstances"%action.capitalize(),self.change,action,region,ids)
+
+    def forAccount(self,arn):
+        """Every account holds its own copy of the same fleet, and the same FakeBackend is returned for an
+        account each time."""
+        account=accountId(arn)
+        with self.lock:
+            backend=self.accounts.get(account)
+            if backend is None:
+                backend=self.accounts[account]=FakeBackend(self.make,self.count,self.regionNames,account,self.latency,
+                    self.throttle,self.transition,self.clock,self.sleep)
+            return backend
+
+#The backend that instances are found and acted on through: in test mode, a FakeBackend serving the test data
+BACKEND=FakeBackend(eval(TESTDATA)) if TESTMODE else BotoBackend()
+
+#The backend for each account being scanned with --accounts, keyed by account id
+BACKENDS={}
+
+def getBackend(account=None):
+    """Return the backend for the account with the given id, or BACKEND if account is None."""
+    return BACKEND if account is None else BACKENDS[account]
+
+def accountBackends(arns,threads=REGIONTHREADS):
+    """Return a dict of backends for the accounts of the IAM roles with the given ARNs (see
+    Backend.forAccount), keyed by account id.  Up to threads roles are assumed at the same time.  An
+    account whose role can't be assumed is reported to stderr and left out."""
+    backends={}
+    todo=Queue.Queue()
+    for arn in arns:
+        todo.put(arn)
+
+    def worker():
+        while True:
+            try:
+                arn=todo.get_nowait()
+            except Queue.Empty:
+                break
+            try:
+                backend=BACKEND.forAccount(arn)
+                backends[backend.account()]=backend
+            except Exception,e:
+                sys.stderr.write("Can't assume role %s: %s\n"%(arn,e))
+
+    workers=[threading.Thread(target=worker) for x in xrange(max(1,min(threads,len(arns))))]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return backends
+
+def getDataPages(data,pageSize=PAGESIZE,apiFilters=None,fields=()):
+    """A generator that will yield a list of Instances for each page of the given list of instance data
+    dicts that match apiFilters, in the same way as getInstancePages does for the API."""
+    data=[d for d in data if matchesApiFilters(d,apiFilters or {})]
+    for start in xrange(0,len(data),pageSize):
+        started=time.time()
+        page=[Instance(d,fields) for d in data[start:start+pageSize]]
+        STATS.phase("wrap",time.time()-started)
+        yield page
+
+def getInstancePages(region=None,pageSize=PAGESIZE,apiFilters=None,fields=()):
+    """A generator that will yield a list of Instances for each page of instances found in the region
+    by the backend in use (see Backend.pages)."""
+    for page in BACKEND.pages(region,pageSize,apiFilters,fields):
+        yield page
+
+def resolveRegions(regions):
+    """Given a list of region names, return the list of regions to be scanned, expanding
+    'all' to the name of every EC2 region.  Duplicates are removed, preserving order."""
+    result=[]
+    for region in regions:
+        if region.lower()=="all":
+            names=BACKEND.regions()
+        else:
+            names=[region]
+        result.extend(n for n in names if n not in result)
+    return result
+
+def getAllInstances(region=None,pageSize=PAGESIZE,apiFilters=None,fields=()):
+    """A generator that will yield an Instance for every instance found.  Instances are yielded
+    as soon as the page that contains them has been fetched, so that the caller can start work
+    while later pages are still to come."""
+    for page in getInstancePages(region,pageSize,apiFilters,fields):
+        for instance in page:
+            yield instance
+
+def getRegionInstances(regions,pageSize=PAGESIZE,threads=REGIONTHREADS,verbose=0,report=None,pager=None,apiFilters=None,fields=()):
+    """A generator that will yield an Instance for every instance found in any of the given
+    regions.  Regions are scanned at the same time by a pool of at most threads worker threads,
+    and pages are yielded as they arrive from any region, so that instances from different regions
+    are interleaved.  Each Instance has its region attribute set to the name of its region.
+    A failure in one region is reported to stderr and does not stop the scan of the others.
+    If report is a dict, it is updated with a (count,seconds,error) tuple for each region.
+    The pager argument, if given, is used instead of getInstancePages to fetch pages for a region,
+    and is passed the region, pageSize, apiFilters and fields."""
+    pager=pager or getInstancePages
+    todo=Queue.Queue()
+    for region in regions:
+        todo.put(region)
+    #Pages waiting to be yielded.  This is bounded so that a fast region can't fill memory
+    #while the caller is still working through earlier pages.
+    pages=Queue.Queue(maxsize=2*threads)
+
+    def worker():
+        """Scan regions until there are none left, putting a (region,page,result) tuple on the
+        pages queue for each page, and one with a page of None when a region is finished."""
+        while True:
+            try:
+                region=todo.get_nowait()
+            except Queue.Empty:
+                break
+            started=time.time()
+            count=0
+            error=None
+            try:
+                for page in pager(region,pageSize,apiFilters,fields):
+                    for instance in page:
+                        instance.region=region
+                    count+=len(page)
+                    pages.put((region,page,None))
+            except Exception,e:
+                error=e
+            pages.put((region,None,(count,time.time()-started,error)))
+        #Flag that this worker has finished
+        pages.put(None)
+
+    workers=[threading.Thread(target=worker) for x in xrange(max(1,min(threads,len(regions))))]
+    for w in workers:
+        #Daemon threads won't keep the process alive if the caller stops early
+        w.daemon=True
+        w.start()
+
+    running=len(workers)
+    while running:
+        item=pages.get()
+        if item is None:
+            running-=1
+            continue
+        (region,page,result)=item
+        if page is not None:
+            for instance in page:
+                yield instance
+        else:
+            (count,seconds,error)=result
+            if report is not None:
+                report[region]=result
+            if error is not None:
+                sys.stderr.write("Error scanning region %s after %.2fs: %s\n"%(region,seconds,error))
+            elif verbose:
+                print "Scanned %d instances in region %s in %.2fs"%(count,region,seconds)
+
+def scanAccounts(todo,pages,backends,pageSize,apiFilters,fields,cache,refresh):
+    """The work done by each process started by getAccountInstances: scan (account,region) pairs from the
+    todo queue until a None is found, putting an (account,region,data,result) tuple on the pages queue for
+    each page, where data is a list of instance snapshots.  When a pair is finished, a tuple with data of
+    None is put on the queue, with a result of (count,seconds,error,calls,throttles) that carries the API
+    call statistics for the pair.  A None is put on the queue when there are no pairs left."""
+    global STATS,CONNECTIONS,CONNECTIONSLOCK
+    #Connections copied from the parent process must not be shared with it
+    (CONNECTIONS,CONNECTIONSLOCK)=({},threading.Lock())
+    while True:
+        item=todo.get()
+        if item is None:
+            break
+        (account,region)=item
+        STATS=Stats()
+        started=time.time()
+        count=0
+        error=None
+        try:
+            backend=backends[account]
+            pager=cache.pager(account,refresh,source=backend.pages) if cache is not None else backend.pages
+            for page in pager(region,pageSize,apiFilters,fields):
+                count+=len(page)
+                pages.put((account,region,[snapshot(i,region) for i in page],None))
+        except Exception,e:
+            #The exception itself may not survive the trip to the parent process
+            error="%s: %s"%(e.__class__.__name__,e)
+        pages.put((account,region,None,(count,time.time()-started,error,dict(STATS.calls),dict(STATS.throttles))))
+    pages.put(None)
+
+def getAccountInstances(backends,regions,pageSize=PAGESIZE,processes=ACCOUNTPROCESSES,verbose=0,report=None,apiFilters=None,
+        fields=(),cache=None,refresh=False):
+    """A generator that will yield an Instance for every instance found in any of the given regions of
+    any of the accounts in backends (a dict of Backends keyed by account id).  The (account,region) pairs
+    are scanned at the same time by a pool of at most processes worker processes, so that a slow account
+    holds up only its own pairs, and pages are yielded as they arrive from any pair.  Instances cross
+    between processes as snapshots (see snapshot), so each Instance is built from a dict, with its account
+    and region attributes set.  A failure in one pair is reported to stderr and does not stop the others.
+    If report is a dict, it is updated with a (count,seconds,error) tuple for each (account,region) pair.
+    If cache is given, it is an InventoryCache that is used for every account, as by InventoryCache.pager."""
+    pairs=[(a,r) for a in sorted(backends) for r in regions]
+    processes=max(1,min(processes,len(pairs)))
+    todo=multiprocessing.Queue()
+    for pair in pairs:
+        todo.put(pair)
+    for n in xrange(processes):
+        todo.put(None)
+    #Pages waiting to be yielded, bounded as in getRegionInstances
+    pages=multiprocessing.Queue(maxsize=2*processes)
+    workers=[multiprocessing.Process(target=scanAccounts,args=(todo,pages,backends,pageSize,apiFilters,fields,cache,refresh))
+        for n in xrange(processes)]
+    for w in workers:
+        w.daemon=True
+        w.start()
+
+    running=len(workers)
+    try:
+        while running:
+            try:
+                item=pages.get(timeout=1)
+            except Queue.Empty:
+                #A worker that was killed never flags that it has finished
+                if not any(w.is_alive() for w in workers):
+                    break
+                continue
+            if item is None:
+                running-=1
+                continue
+            (account,region,data,result)=item
+            if data is not None:
+                started=time.time()
+                page=[Instance(d,fields) for d in data]
+                for instance in page:
+                    (instance.account,instance.region)=(account,region)
+                STATS.phase("wrap",time.time()-started)
+                for instance in page:
+                    yield instance
+            else:
+                (count,seconds,error,calls,throttles)=result
+                STATS.merge(calls,throttles)
+                if report is not None:
+                    report[(account,region)]=(count,seconds,error)
+                if error is not None:
+                    sys.stderr.write("Error scanning account %s region %s after %.2fs: %s\n"%(account,region,seconds,error))
+                elif verbose:
+                    print "Scanned %d instances in account %s region %s in %.2fs"%(count,account,region,seconds)
+    finally:
+        #If the caller stopped early, the workers may be waiting to put more pages
+        for w in workers:
+            if w.is_alive():
+                w.terminate()
+            w.join()
+
+def accountKey(cache):
+    """Return the key that identifies the AWS account in the given InventoryCache: the id of the account
+    that the credentials in use belong to.  Finding that out is a network call, so the account id is kept
+    in the cache against a hash of the access key, and a later run with the same key needs no call."""
+    key=BACKEND.accessKey()
+    if not key:
+        return BACKEND.account()
+    digest=hashlib.sha256(key).hexdigest()
+    account=cache.account(digest)
+    if account is None:
+        account=BACKEND.account()
+        cache.remember(digest,account)
+    return account
+
+def cacheable(value):
+    """Return the value in a form that can be stored in the inventory cache as JSON, and that lists the
+    same way as the value itself: dicts and lists are copied with their contents made cacheable, and
+    any other object that isn't a simple type is replaced by its unicode representation."""
+    if type(value) in CACHETYPES:
+        return value
+    if isinstance(value,dict):
+        return dict((k if type(k) in types.StringTypes else unicode(k),cacheable(v)) for (k,v) in value.iteritems())
+    if isinstance(value,(list,tuple)):
+        return [cacheable(v) for v in value]
+    return unicode(value)
+
+def snapshot(instance,region):
+    """Return a dict of the attributes of the given Instance, as stored in the inventory cache, with
+    values made cacheable (see cacheable).  The connection is left out.  A boto instance keeps some
+    attributes as properties, so those in CACHEPROPERTIES are looked up as well."""
+    data=instance.instance
+    if instance.isTest():
+        items=data.iteritems()
     else:
-        #Not in test mode - yield actual instance data
-        #The get_all_instances actually returns a list of reservations, each of which contains a list of instances.  So
-        #we reduce() this via a generator to a list of instances, then yield each one.
-        for instance in reduce(lambda x,y: x+y,(r.instances for r in boto.ec2.connect_to_region('ap-southeast-2').get_all_instances()),[]):
-            yield Instance(instance)
+        items=vars(data).items()+[(k,getattr(data,k,None)) for k in CACHEPROPERTIES]
+    result=dict((k,cacheable(v)) for (k,v) in items if not k.startswith('_') and k!="connection")
+    result.update(id=instance.id,state=getattr(instance,"state",None),region=region,tags=instance.tags)
+    return result
+
+class InventoryCache:
+    """A local SQLite inventory of the instances in each (account,region), so that runs that only list
+    instances can be served without scanning the region again.  An inventory older than ttl seconds is
+    not used.  Each method opens its own connection, so that the cache may be used from the region
+    worker threads."""
+    def __init__(self,path=CACHEFILE,ttl=CACHETTL):
+        self.path=path
+        self.ttl=ttl
+
+    def connect(self):
+        """Return a new connection to the cache database, creating the tables if necessary."""
+        db=sqlite3.connect(self.path,timeout=60)
+        db.execute("create table if not exists scans (account text,region text,scanned real,primary key (account,region))")
+        db.execute("create table if not exists instances (account text,region text,data text)")
+        db.execute("create index if not exists instances_scan on instances (account,region)")
+        db.execute("create table if not exists accounts (credentials text primary key,account text)")
+        return db
+
+    def account(self,credentials):
+        """Return the account id remembered for the given hash of an access key, or None."""
+        db=self.connect()
+        try:
+            row=db.execute("select account from accounts where credentials=?",(credentials,)).fetchone()
+            return row[0] if row is not None else None
+        finally:
+            db.close()
+
+    def remember(self,credentials,account):
+        """Remember the account id for the given hash of an access key."""
+        db=self.connect()
+        try:
+            with db:
+                db.execute("insert or replace into accounts (credentials,account) values (?,?)",(credentials,account))
+        finally:
+            db.close()
+
+    def get(self,account,region):
+        """Return the list of instance data dicts in the inventory for the account and region, or None
+        if there is no inventory or it is older than the ttl."""
+        db=self.connect()
+        try:
+            row=db.execute("select scanned from scans where account=? and region=?",(account,region)).fetchone()
+            if row is None or time.time()-row[0]>self.ttl:
+                return None
+            return [json.loads(d) for (d,) in db.execute("select data from instances where account=? and region=?",(account,region))]
+        finally:
+            db.close()
+
+    def put(self,account,region,data):
+        """Replace the inventory for the account and region with the given list of instance data dicts."""
+        db=self.connect()
+        try:
+            with db:
+                db.execute("delete from instances where account=? and region=?",(account,region))
+                db.executemany("insert into instances (account,region,data) values (?,?,?)",
+                    ((account,region,json.dumps(d,separators=(',',':'))) for d in data))
+                db.execute("insert or replace into scans (account,region,scanned) values (?,?,?)",(account,region,time.time()))
+        finally:
+            db.close()
+
+    def pager(self,account,refresh=False,verbose=0,source=None):
+        """Return a function that may be passed as the pager to getRegionInstances.  It serves pages from
+        the inventory for the account if that is fresh (and refresh is False), and otherwise scans the
+        whole region with source (by default, getInstancePages) and stores the result.  Any apiFilters
+        are applied locally, because the inventory must hold the whole region to be of use to later runs."""
+        source=source or getInstancePages
+        def pager(region,pageSize,apiFilters,fields):
+            data=None if refresh else self.get(account,region)
+            if data is not None:
+                if verbose:
+                    print "Using cached inventory of %d instances for region %s"%(len(data),region)
+                for page in getDataPages(data,pageSize,apiFilters,fields):
+                    yield page
+            else:
+                #Keep a snapshot of every instance until the scan is complete, so that a failed scan
+                #doesn't replace a good inventory with a partial one.
+                data=[]
+                for page in source(region,pageSize,None,fields):
+                    snapshots=[snapshot(i,region) for i in page]
+                    data.extend(snapshots)
+                    yield [i for (i,d) in zip(page,snapshots) if matchesApiFilters(d,apiFilters or {})]
+                self.put(account,region,data)
+        return pager
+
+def liveInstances(instances,includes,excludes,fields=(),chunkSize=WAITCHUNK):
+    """A generator that takes instances which may have come from the inventory cache, and yields a live
+    Instance for each one that still passes the include and exclude filters.  The includes must be all
+    of them, including any that were pushed down to the API, because the cached instances were only
+    checked against a stale copy.  Instances are described again in chunks of up to chunkSize ids per
+    account and region (no more than the API accepts in one filter), so that an action is never based
+    on a stale state."""
+    pending={}
+
+    def fetch(key):
+        (account,region)=key
+        ids=[i.id for i in pending.pop(key)]
+        for i in filtered(getBackend(account).instances(region,ids,fields),includes,excludes):
+            (i.account,i.region)=(account,region)
+            yield i
+
+    for i in instances:
+        key=(getattr(i,"account",None),i.region)
+        chunk=pending.setdefault(key,[])
+        chunk.append(i)
+        if len(chunk)>=chunkSize:
+            for live in fetch(key):
+                yield live
+    for key in sorted(pending.keys()):
+        for live in fetch(key):
+            yield live
 
 class Filter:
     """Represents a single include/exclude filter.
@@ -304,31 +1420,470 @@ def createFilterList(data):
     of Filters."""
     return [Filter(x) for x in data if type(x) in (types.TupleType,types.ListType) and len(x)==3]
 
+def filterFields(filters):
+    """Given a list of Filters, return the sorted list of Instance attribute names that they use."""
+    return sorted(set(f.keyword for f in filters if f.tag is None))
+
+class FilterSet:
+    """A list of Filters compiled into a single matcher.  Use call syntax to check if a given instance
+    matches any of the Filters, with the same result as any(f(instance) for f in filters).
+    Filters are grouped by the attribute (or tag) that they look at, so that each attribute is fetched
+    only once per instance.  Within a group, exact-match values become a set that is checked with a
+    single hash lookup, and regexes are combined into a single alternation pattern.  Groups are
+    checked cheapest-first: those with only exact values come before those with regexes."""
+
+    #Regexes that use these constructs can't safely be combined with others, because global flags
+    #would apply to the whole alternation and group numbers (used by backreferences and conditional
+    #groups) would change.
+    UNCOMBINABLE=re.compile(r"\(\?[iLmsux]|\\[1-9]|\(\?P=|\(\?\(")
+
+    def __init__(self,filters):
+        groups={}
+        for f in filters:
+            #Group on (isTag,name) so that a tag and an attribute with the same name stay apart
+            key=(f.tag is not None,f.tag if f.tag is not None else f.keyword)
+            groups.setdefault(key,[]).append(f)
+        self.groups=[self.compileGroup(isTag,name,fs) for ((isTag,name),fs) in groups.iteritems()]
+        #Cheapest first: exact only, then presence checks, then regexes
+        self.groups.sort(key=lambda g: (len(g[4]),g[3]))
+
+    def compileGroup(self,isTag,name,filters):
+        """Return an (isTag,name,exact,presence,regexes) tuple for the Filters that look at the
+        same attribute or tag: exact is a frozenset of values, presence is True if any Filter
+        only checks for a non-empty value, and regexes is a list of compiled patterns."""
+        exact=frozenset(f.value for f in filters if not f.isRegex and f.value is not None)
+        presence=any(f.value is None for f in filters)
+        patterns=[f._value for f in filters if f.isRegex and f.value is not None]
+        regexes=[f.value for f in filters if f.isRegex and f.value is not None and FilterSet.UNCOMBINABLE.search(f._value)]
+        combinable=[p for p in patterns if not FilterSet.UNCOMBINABLE.search(p)]
+        if len(combinable)>1:
+            try:
+                regexes.insert(0,re.compile("|".join("(?:%s)"%p for p in combinable)))
+            except re.error:
+                #For example, the same group name used in two patterns
+                regexes[:0]=[re.compile(p) for p in combinable]
+        elif combinable:
+            regexes.insert(0,re.compile(combinable[0]))
+        return (isTag,name,exact,presence,regexes)
+
+    def __len__(self):
+        return len(self.groups)
+
+    def __call__(self,instance):
+        """Return True if any of the Filters matches the given instance."""
+        for (isTag,name,exact,presence,regexes) in self.groups:
+            if isTag:
+                attr=getattr(instance,"tags",{}).get(name)
+            else:
+                attr=getattr(instance,name,None)
+            if attr is None:
+                continue
+            if exact:
+                try:
+                    if attr in exact:
+                        return True
+                except TypeError:
+                    #An unhashable value (such as a list) can never equal a filter value
+                    pass
+            if presence and attr.strip():
+                return True
+            for r in regexes:
+                if r.match(attr) is not None:
+                    return True
+        return False
+
+def planFilters(includes):
+    """Given a list of include Filters (as returned by createFilterList), work out which of them
+    can be pushed down to the DescribeInstances API.  Return a (apiFilters,localIncludes) tuple,
+    where apiFilters is a dict of API filter names to lists of values (empty if nothing can be
+    pushed down) and localIncludes is the list of include Filters that must still be applied here.
+    Include filters are ORed together but API filters with different names are ANDed, so we can
+    only push down when every include is an exact match that maps onto the same API filter name.
+    Tag filters are pushed down as tag-value filters, which select a superset of the matching
+    instances (EC2 tag keys are case-sensitive), so they are also kept as local includes.  Any
+    filter whose value contains an EC2 wildcard character is kept as a local include for the
+    same reason."""
+    apiFilters={}
+    localIncludes=[]
+    for f in includes:
+        if f.isRegex or f.value is None:
+            return ({},includes)
+        if f.tag is not None:
+            name="tag-value"
+        elif f.keyword in APIFILTERS:
+            name=APIFILTERS[f.keyword]
+        else:
+            return ({},includes)
+        if apiFilters and name not in apiFilters:
+            return ({},includes)
+        values=apiFilters.setdefault(name,[])
+        if f.value not in values:
+            values.append(f.value)
+        if f.tag is not None or '*' in f.value or '?' in f.value:
+            localIncludes.append(f)
+    return (apiFilters,localIncludes)
+
 def filtered(instances,includes,excludes):
-    """Given a list of instances and filters for include/exclude, return the
-    list of instances that pass the filters.
+    """Given an iterable of instances and filters for include/exclude, return an
+    iterator over the instances that pass the filters.  Instances are consumed lazily,
+    so that filtering can begin before all instances have been fetched.
     The rules for matching are:
     1. Include filtering comes before exclude filtering.
     2. If there are no include filters, all instances are considered to be included.
     3. If there are no exclude filters, all included instances are returned.
+    The filters are compiled into a FilterSet for each of include and exclude.
     """
     if includes:
         # Check each instance against all filters (stopping at the first one that matches)
-        included=filter(lambda i: any(f(i) for f in includes), instances)
+        includes=FilterSet(includes)
+        if STATS.enabled:
+            includes=STATS.timed("filter",includes)
+        included=(i for i in instances if includes(i))
     else:
         included=instances
     #print "Included=%s"%map(str,included)
 
     if excludes:
         # Check each instance against all filters (stopping at the first one that matches)
-        passed=filter(lambda i: not any(f(i) for f in excludes), included)
+        excludes=FilterSet(excludes)
+        if STATS.enabled:
+            excludes=STATS.timed("filter",excludes)
+        passed=(i for i in included if not excludes(i))
     else:
         passed=included
 
-    return passed
+    return iter(passed)
+
+#The outcome of a single batched action call: the action and region, the lists of instance ids
+#that succeeded and failed, the exception raised by the call (or None), and the account id (or None
+#if only the default account is being scanned).
+BatchResult=collections.namedtuple("BatchResult","action region succeeded failed error account")
+
+class ActionBatcher:
+    """Collects the instances that an action is to be applied to, grouped by action, account and region, and
+    applies the action with one API call per batch of at most batchSize instance ids (split further only
+    if EC2 rejects the call, see attempt).  The result of each batch is kept as a BatchResult in the
+    results list.
+    If inFlight is more than one, full batches are handed to that many worker threads, so that up to
+    inFlight calls are in progress while the caller carries on scanning and filtering.  The queue of
+    batches waiting for a worker is bounded, so a caller that gets too far ahead waits for the workers,
+    which in turn holds back scanning and keeps memory use bounded.
+    Actions are applied through the given backend, or the backend for each instance's account (see
+    getBackend) if it's not given."""
+    def __init__(self,batchSize=BATCHSIZE,verbose=0,inFlight=INFLIGHT,backend=None):
+        self.batchSize=max(1,batchSize)
+        self.backend=backend
+        self.verbose=verbose
+        self.inFlight=max(1,inFlight)
+        #Pending instances, keyed by (action,account,region)
+        self.batches={}
+        self.results=[]
+        self.lock=threading.Lock()
+        #Batches waiting for a worker thread, and the worker threads (started when first needed)
+        self.queue=None
+        self.workers=[]
+
+    def add(self,action,instance):
+        """Add an instance to the batch for the given action, sending the batch if it is full."""
+        key=(action,getattr(instance,"account",None),getattr(instance,"region",None))
+        batch=self.batches.setdefault(key,[])
+        batch.append(instance)
+        if len(batch)>=self.batchSize:
+            self.send(key)
+
+    def flush(self):
+        """Send all pending batches, and wait for any worker threads to finish sending them."""
+        for key in sorted(self.batches.keys()):
+            self.send(key)
+        if self.workers:
+            for w in self.workers:
+                self.queue.put(None)
+            for w in self.workers:
+                w.join()
+            (self.queue,self.workers)=(None,[])
+
+    def send(self,key):
+        """Send the pending batch for the given (action,account,region) key.  If there are worker threads, the
+        batch is queued for them, otherwise it's sent now and the BatchResult is returned."""
+        batch=self.batches.pop(key,[])
+        if not batch:
+            return
+        if self.inFlight==1:
+            return self.call(key,batch)
+        if not self.workers:
+            self.queue=Queue.Queue(maxsize=self.inFlight)
+            self.workers=[threading.Thread(target=self.work) for x in xrange(self.inFlight)]
+            for w in self.workers:
+                w.daemon=True
+                w.start()
+        self.queue.put((key,batch))
+
+    def work(self):
+        """Worker thread: send queued batches until a None is found on the queue."""
+        while True:
+            item=self.queue.get()
+            if item is None:
+                break
+            self.call(*item)
+
+    def attempt(self,backend,action,region,ids):
+        """Apply the action to the instances with the given ids in one call, and return a (done,errors) tuple
+        of the set of ids whose state changed and a dict of the exception for each id that failed.  EC2
+        rejects the whole call if any one instance is unknown or in the wrong state, so a call that fails
+        with one of REJECTIONCODES is split in half and each half is tried again, until the instances at
+        fault are found.  Any other error (such as throttling, or a lack of permission) fails the batch."""
+        try:
+            return (set(backend.act(action,region,ids)),{})
+        except Exception,e:
+            if getattr(e,"error_code",None) not in REJECTIONCODES or len(ids)==1:
+                return (set(),dict((x,e) for x in ids))
+        half=len(ids)//2
+        (done,errors)=self.attempt(backend,action,region,ids[:half])
+        (moreDone,moreErrors)=self.attempt(backend,action,region,ids[half:])
+        done.update(moreDone)
+        errors.update(moreErrors)
+        return (done,errors)
+
+    def call(self,key,batch):
+        """Apply the action for the given (action,account,region) key to the batch of instances, and record
+        and return the result."""
+        (action,account,region)=key
+        backend=self.backend or getBackend(account)
+        ids=[i.id for i in batch]
+        started=time.time()
+        (done,errors)=self.attempt(backend,action,region,ids)
+        failed=[x for x in ids if x not in done]
+        #The first error stands for them all in the BatchResult; all the different errors are reported
+        error=next((errors[x] for x in failed if x in errors),None)
+        result=BatchResult(action,region,[x for x in ids if x in done],failed,error,account)
+        with self.lock:
+            self.results.append(result)
+        STATS.phase("act",time.time()-started)
+        STATS.count("acted",len(result.succeeded))
+        STATS.count("failed",len(result.failed))
+        where="region %s"%region if account is None else "account %s region %s"%(account,region)
+        if result.failed:
+            reasons=[]
+            for x in failed:
+                if x in errors and str(errors[x]) not in reasons:
+                    reasons.append(str(errors[x]))
+            sys.stderr.write("Failed to %s %d instances in %s: %s%s\n"%(action,len(result.failed),where,
+                ",".join(result.failed)," (%s)"%"; ".join(reasons) if reasons else ""))
+        if self.verbose and result.succeeded:
+            print "Sent %s for %d instances in %s: %s"%(action,len(result.succeeded),where,",".join(result.succeeded))
+        return result
+
+class Waiter:
+    """Tracks the instances that actions were applied to, and waits for each to reach the state that its
+    action leads to.  States are polled in bulk, with up to chunkSize ids per call, and instances drop out
+    of the poll as they converge or fail.  The fetch function, if given, is used instead of the backend
+    for each account (see getBackend) to get the Instances for an account, region and list of ids."""
+
+    #The state that each action leads to, and the states from which that can no longer happen
+    TARGETS={"start":"running","stop":"stopped","terminate":"terminated"}
+    FAILURES={"start":("shutting-down","terminated"),"stop":("shutting-down","terminated"),"terminate":()}
+
+    def __init__(self,chunkSize=WAITCHUNK,interval=WAITINTERVAL,verbose=0,fetch=None,clock=time.time,sleep=time.sleep):
+        self.chunkSize=max(1,chunkSize)
+        self.interval=interval
+        self.verbose=verbose
+        self.fetch=fetch or (lambda account,region,ids: getBackend(account).instances(region,ids))
+        self.clock=clock
+        self.sleep=sleep
+        #The action applied to each instance still being waited for, keyed by (account,region,id)
+        self.pending={}
+        #(account,region,id,action,state) tuples for instances that converged and that failed
+        self.converged=[]
+        self.failed=[]
+
+    def track(self,results):
+        """Start waiting for the instances that succeeded in the given list of BatchResults."""
+        for r in results:
+            for id in r.succeeded:
+                self.pending[(r.account,r.region,id)]=r.action
+
+    def poll(self):
+        """Fetch the states of all the pending instances, and move any that have converged or failed."""
+        regions={}
+        for (account,region,id) in self.pending:
+            regions.setdefault((account,region),[]).append(id)
+        for ((account,region),ids) in sorted(regions.items()):
+            for start in xrange(0,len(ids),self.chunkSize):
+                chunk=ids[start:start+self.chunkSize]
+                states=dict((i.id,getattr(i,"state",None)) for i in self.fetch(account,region,chunk))
+                for id in chunk:
+                    action=self.pending[(account,region,id)]
+                    state=states.get(id)
+                    if state==Waiter.TARGETS[action] or (state is None and action=="terminate"):
+                        #A terminated instance may already have disappeared
+                        self.converged.append((account,region,id,action,state or "terminated"))
+                    elif state is None or state in Waiter.FAILURES[action]:
+                        self.failed.append((account,region,id,action,state or "not found"))
+                    else:
+                        continue
+                    del self.pending[(account,region,id)]
+
+    def wait(self,timeout=WAITTIMEOUT):
+        """Poll until every instance has converged or failed, or until timeout seconds have passed.
+        Return True if every instance converged."""
+        deadline=self.clock()+timeout
+        while True:
+            self.poll()
+            if self.verbose:
+                print "Waiting: %d converged, %d pending, %d failed"%(len(self.converged),len(self.pending),len(self.failed))
+            if not self.pending or self.clock()>=deadline:
+                break
+            self.sleep(max(0,min(self.interval,deadline-self.clock())))
+        return not (self.pending or self.failed)
+
+    def summary(self):
+        """Print a summary of the instances that converged, are still pending and failed."""
+        print "Converged: %d, still pending: %d, failed: %d"%(len(self.converged),len(self.pending),len(self.failed))
+        for ((account,region,id),action) in sorted(self.pending.items()):
+            print "Pending: id:%s Region:%s%s (waiting to %s)"%(id,region," Account:%s"%account if account else "",action)
+        for (account,region,id,action,state) in self.failed:
+            print "Failed: id:%s Region:%s%s (could not %s, state %s)"%(id,region," Account:%s"%account if account else "",action,state)
+
+class PlanWriter:
+    """Stands in for an ActionBatcher when making a plan: each instance that would be acted on is written
+    to the plan file f as a line of JSON, with its account (or null), region, id, action and current state."""
+    def __init__(self,f):
+        self.f=f
+        self.count=0
+        #Nothing is acted on, so there are never any BatchResults
+        self.results=[]
+
+    def add(self,action,instance):
+        """Write the instance and action to the plan."""
+        self.f.write(json.dumps({"account":getattr(instance,"account",None),"region":getattr(instance,"region",None),
+            "id":instance.id,"action":action,
+            "state":getattr(instance,"state",None)},separators=(',',':'),sort_keys=True)+"\n")
+        self.count+=1
+
+    def flush(self):
+        self.f.flush()
+
+class RowWriter:
+    """Writes each listed instance to f as a row that holds just the given fields: as a line of JSON for
+    the jsonl format, or as a line of CSV (after a header line of the field names) for csv.  A field is
+    an attribute name, or tags.<tagname> for a tag, as for filters.  A missing attribute or tag is
+    written as null (or an empty CSV value), and a value that isn't a simple type is written as a
+    string.  Use call syntax to write an instance."""
+    def __init__(self,f,format="jsonl",fields=OUTPUTFIELDS):
+        self.f=f
+        self.format=format
+        self.fields=list(fields)
+        #The attribute names among the fields, which may be fetched along with those used by filters
+        self.attributes=[n for n in self.fields if not (n.startswith("tags.") or n.startswith("tag."))]
+        self.count=0
+        if format=="csv":
+            self.writer=csv.writer(f)
+            self.writer.writerow(self.fields)
+
+    def value(self,instance,field):
+        """Return the value of the field for the instance, or None."""
+        if field.startswith("tags.") or field.startswith("tag."):
+            return instance.tags.get(field[field.find('.')+1:].lower())
+        return getattr(instance,field,None)
+
+    def csvValue(self,value):
+        """Return the value as a CSV-writable string."""
+        if value is None:
+            return ""
+        if type(value) in (types.StringType,types.UnicodeType):
+            return value.encode('utf-8') if type(value)==types.UnicodeType else value
+        if type(value) in CACHETYPES:
+            return str(value)
+        return json.dumps(value,default=unicode,sort_keys=True)
+
+    def __call__(self,instance):
+        values=[self.value(instance,n) for n in self.fields]
+        if self.format=="csv":
+            self.writer.writerow([self.csvValue(v) for v in values])
+        else:
+            self.f.write(json.dumps(collections.OrderedDict(zip(self.fields,values)),default=unicode,separators=(',',':'))+"\n")
+        self.count+=1
+
+def readPlan(path):
+    """Read the plan file at path and return a list of dicts, one for each planned instance.  Raise
+    ValueError if a line can't be parsed, or lacks any of the id, action, region and state that applyPlan needs."""
+    plan=[]
+    with open(path) as f:
+        for (n,line) in enumerate(f,1):
+            try:
+                entry=json.loads(line)
+                if entry["action"] not in Waiter.TARGETS or not entry["id"]:
+                    raise ValueError("unknown action %s"%entry["action"])
+                for name in ("region","state"):
+                    if name not in entry:
+                        raise ValueError("no %s for %s"%(name,entry["id"]))
+            except (ValueError,KeyError,TypeError),e:
+                raise ValueError("%s line %d: %s"%(path,n,e))
+            plan.append(entry)
+    return plan
+
+def applyPlan(plan,batcher,chunkSize=WAITCHUNK,verbose=0,fetch=None):
+    """Check the current states of the instances in the plan in bulk, with up to chunkSize ids per call,
+    and pass each instance whose state is unchanged since the plan was made to the batcher with its
+    planned action.  Instances that have changed state or gone are skipped, as are those in an account
+    that has no backend (because --accounts didn't name it, or its role couldn't be assumed).  The fetch
+    function, if given, is used instead of the backend for each account (see getBackend) to get the
+    Instances for an account, region and list of ids.  Return the number of instances skipped."""
+    reachable=(lambda account: True) if fetch else (lambda account: account is None or account in BACKENDS)
+    fetch=fetch or (lambda account,region,ids: getBackend(account).instances(region,ids))
+    regions={}
+    for entry in plan:
+        regions.setdefault((entry.get("account"),entry["region"]),[]).append(entry)
+    skipped=0
+    for ((account,region),entries) in sorted(regions.items()):
+        if not reachable(account):
+            sys.stderr.write("Skipping %d instances in account %s region %s: the account was not reached with --accounts\n"%(
+                len(entries),account,region))
+            skipped+=len(entries)
+            continue
+        for start in xrange(0,len(entries),chunkSize):
+            chunk=entries[start:start+chunkSize]
+            live=dict((i.id,i) for i in fetch(account,region,[e["id"] for e in chunk]))
+            for entry in chunk:
+                i=live.get(entry["id"])
+                state=getattr(i,"state",None) if i is not None else None
+                if state is None or state!=entry["state"]:
+                    sys.stderr.write("Skipping %s in %sregion %s: state was %s when planned, now %s\n"%(entry["id"],
+                        "account %s "%account if account is not None else "",region,
+                        entry["state"],state or "not found"))
+                    skipped+=1
+                    continue
+                (i.account,i.region)=(account,region)
+                if verbose:
+                    print "Applying %s to %s"%(entry["action"],i)
+                batcher.add(entry["action"],i)
+    return skipped
 
 def test():
     """Run self-tests"""
+    global SCHEDULER,BACKEND,BOTO
+    @contextlib.contextmanager
+    def silenced(name):
+        """Send sys.stdout or sys.stderr (by name) to /dev/null for the duration of a with block"""
+        saved=getattr(sys,name)
+        with open(os.devnull,"w") as devnull:
+            setattr(sys,name,devnull)
+            try:
+                yield
+            finally:
+                setattr(sys,name,saved)
+
+    class Clock:
+        """A fake clock that only moves when slept on (or set), for testing waits without waiting"""
+        def __init__(self):
+            self.now=0.0
+        def __call__(self):
+            return self.now
+        def sleep(self,seconds):
+            self.now+=seconds
+
+    assert "boto" not in sys.modules,"Expected boto not to be imported in test mode"
+
     assert splitKV("a=b")==('a','b')
     assert splitKV("this is a keyword = this is a value")==('this is a keyword','this is a value')
     assert splitKV("Alpha=b")==("alpha","b")
@@ -341,6 +1896,7 @@ def test():
     assert not a['includes'],"Expected empty includes"
     assert not a['excludes'],"Expected empty excludes"
     assert not a['verbose'],"Expected empty verbose"
+    assert not a['region'],"Expected empty region"
 
     assert arguments(["--start"]).action=='start',"Expected action to be start"
     assert arguments(["--stop"]).action=='stop',"Expected action to be stop"
@@ -369,21 +1925,39 @@ def test():
     excludeFilters = createFilterList(a)
     assert len(excludeFilters)==3,"Expected three exclude filters"
 
+    assert arguments([]).batchSize==BATCHSIZE,"Expected default batch size"
+    assert arguments("--batch-size 20".split()).batchSize==20,"Expected batch size to be 20"
+
+    assert splitList("a, b,,c")==["a","b","c"]
+    assert arguments("-r ap-southeast-2".split()).region==["ap-southeast-2"],"Expected one region"
+    assert arguments("-r us-east-1,eu-west-1".split()).region==["us-east-1","eu-west-1"],"Expected two regions"
+    assert resolveRegions(["us-east-1","all","us-east-1"])==["us-east-1"]+TESTREGIONS,"Expected all to expand"
+
+    #Instances hold only a few attributes themselves, and fetch others from the underlying object
+    data={"id":"o0","state":"running","tags":{"Name":"N"},"kernel":"k","ramdisk":"r"}
+    o0=Instance(data,["ramdisk"])
+    assert (o0.id,o0.state,o0.tags)==("o0","running",{"name":"N"}),"Expected FIELDS to be copied"
+    assert o0._extra=={"ramdisk":"r"},"Expected only ramdisk to have been fetched, got %s"%o0._extra
+    assert o0.kernel=="k" and o0._extra=={"ramdisk":"r","kernel":"k"},"Expected kernel to be fetched on use"
+    assert getattr(o0,"region",None) is None and getattr(o0,"missing",None) is None,"Expected missing attributes"
+    assert not hasattr(o0,"__dict__"),"Expected no instance dict"
+    assert filterFields(createFilterList([("tags.name","x",False),("kernel","y",True)]))==["kernel"]
+
     # Basic filtering tests
     o1=Instance({"id":"o1","alpha":"beta","eric":"sow"})
     o2=Instance({"id":"o2","alpha":"gamma","eric":"pig"})
     o3=Instance({"id":"o3","alpha":"delta","eric":"swine"})
     il1=[o1,o2,o3]
 
-    l1=filtered(il1,[],[])
+    l1=list(filtered(il1,[],[]))
     assert len(l1)==3,"Expected 3 instances, got %s"%l1
     assert l1==[o1,o2,o3],"Expected all instances, got %s"%l1
 
-    l2=filtered(il1,includeFilters,[])
+    l2=list(filtered(il1,includeFilters,[]))
     assert len(l2)==2,"Expected 2 instances, got %s"%l2
     assert l2==[o1,o2],"Expected first two instances, got %s"%l1
 
-    l3=filtered(il1,includeFilters,excludeFilters)
+    l3=list(filtered(il1,includeFilters,excludeFilters))
     assert len(l3)==1,"Expected 1 instance, got %s"%l3
     assert l3==[o2],"Expected second instance, got %s"%map(str,l3)
 
@@ -393,12 +1967,629 @@ def test():
     assert instances[1].tags["name"]=="Sample2","Expected instance 1 to have name Sample2"
     assert instances[2].state=="terminated","Expected instance 3 to have state 'terminated'"
 
+    assert arguments([]).pageSize==PAGESIZE,"Expected default page size"
+    assert arguments("--page-size 50".split()).pageSize==50,"Expected page size to be 50"
+
+    #Paging should split the instances but not lose or reorder any
+    pages=list(getInstancePages(pageSize=2))
+    assert map(len,pages)==[2,1],"Expected pages of 2 and 1 instances, got %s"%map(len,pages)
+    assert [i.id for p in pages for i in p]==[i.id for i in instances],"Expected paged ids to match"
+
+    #The fake backend should simulate paging, state transitions, latency and throttling
+    clock=Clock()
+    fake=FakeBackend(lambda n: {"id":"i-%d"%n,"state":"running" if n%2 else "stopped"},count=5,latency=0.5,
+        transition=10,clock=clock,sleep=clock.sleep)
+    assert map(len,fake.pages("r1",2))==[2,2,1] and fake.calls==3 and clock.now==1.5,"Expected three pages with latency"
+    assert [i.id for p in fake.pages("r1",2,{"instance-state-name":["running"]}) for i in p]==["i-1","i-3"]
+    assert [i.id for i in fake.instances("r1",["i-4","i-0","i-9"])]==["i-0","i-4"],"Expected only known ids"
+    for (ids,code) in ((["i-1","i-3","i-9"],"InvalidInstanceID.NotFound"),(["i-1","i-3","i-0"],"IncorrectInstanceState")):
+        try:
+            fake.act("stop","r1",ids)
+            assert False,"Expected stopping %s to be rejected"%ids
+        except RejectedError,e:
+            assert e.error_code==code,"Expected %s, got %s"%(code,e.error_code)
+    assert [i.state for i in fake.instances("r1",["i-1","i-3"])]==["running"]*2,"Expected a rejected call to change nothing"
+    assert sorted(fake.act("stop","r1",["i-1","i-3"]))==["i-1","i-3"],"Expected running instances to stop"
+    assert [i.state for i in fake.instances("r1",["i-1","i-3"])]==["stopping"]*2,"Expected stopping"
+    assert fake.instances("r2",["i-1"])[0].state=="running","Expected other regions to be unaffected"
+    clock.now+=10
+    assert [i.state for i in fake.instances("r1",["i-1","i-3"])]==["stopped"]*2,"Expected stopped after the transition"
+    assert fake.act("start","r1",["i-1"])==["i-1"] and fake.act("terminate","r1",["i-1"])==["i-1"]
+    try:
+        fake.act("start","r1",["i-1"])
+        assert False,"Expected a shutting-down instance not to start"
+    except RejectedError,e:
+        assert e.error_code=="IncorrectInstanceState"
+    #A batch rejected by the fake because of one instance should still succeed for all the others
+    fake=FakeBackend(lambda n: {"id":"m%d"%n,"state":"stopped" if n<99 else "stopping"},count=100)
+    batcher=ActionBatcher(backend=fake)
+    with silenced("stderr"):
+        for n in xrange(100):
+            batcher.add("start",Instance({"id":"m%d"%n,"region":"r1"}))
+        batcher.add("stop",Instance({"id":"m0","region":"r1"}))
+        batcher.add("stop",Instance({"id":"m-gone","region":"r1"}))
+        batcher.flush()
+    (started,stopped)=batcher.results
+    assert len(started.succeeded)==99 and started.failed==["m99"],"Expected only m99 to fail, got %s"%started.failed
+    assert started.error.error_code=="IncorrectInstanceState","Expected the error for m99, got %s"%started.error
+    assert (stopped.succeeded,stopped.failed,stopped.error.error_code)==(["m0"],["m-gone"],"InvalidInstanceID.NotFound")
+    fake=FakeBackend(eval(TESTDATA),throttle=1.0,seed=1)
+    scheduler=SCHEDULER
+    SCHEDULER=Scheduler(retries=2,backoff=0)
+    try:
+        fake.act("stop","r1",["i-e48f12d9"])
+        assert False,"Expected every call to be throttled"
+    except ThrottledError:
+        pass
+    finally:
+        SCHEDULER=scheduler
+    assert fake.calls==3,"Expected the throttled call to be retried twice, got %d calls"%fake.calls
+
+    #Scanning several regions should merge all instances, tagging each with its region
+    report={}
+    results=list(getRegionInstances(["r1","r2","r3"],threads=2,report=report))
+    assert len(results)==9,"Expected nine instances, got %d"%len(results)
+    assert sorted(i.region for i in results)==["r1"]*3+["r2"]*3+["r3"]*3,"Expected instances tagged by region"
+    assert sorted(report.keys())==["r1","r2","r3"],"Expected a report for each region"
+    assert report["r2"][0]==3 and report["r2"][2] is None,"Expected region r2 to report 3 instances"
+
+    #A failing region must not stop the others
+    def pager(region,pageSize,apiFilters,fields):
+        if region=="bad":
+            raise RuntimeError("failed")
+        return getInstancePages(region,pageSize,apiFilters,fields)
+    report={}
+    with silenced("stderr"):
+        results=list(getRegionInstances(["bad","good"],report=report,pager=pager))
+    assert len(results)==3 and results[0].region=="good","Expected only instances from the good region"
+    assert isinstance(report["bad"][2],RuntimeError),"Expected the bad region to report its error"
+
+    #A FilterSet must give the same answer as checking each of its Filters in turn
+    fs=createFilterList([("id","i-e48f12d9",False),("id","i-e48f12db",False),("tags.name","Sample[12]",True),
+        ("tags.name","S.*3",True),("state","^(?i)STOPPED",True),("vpc_id",None,False),("groups","x",False),
+        ("id","x(y)",True),("id","(a)?(?(1)b|c)",True)])
+    for n in xrange(len(fs)):
+        for subset in (fs[n:],fs[:n],fs[n:n+1]):
+            compiled=FilterSet(subset)
+            for i in instances+[o1,o2,Instance({"id":"ab"})]:
+                assert compiled(i)==any(f(i) for f in subset),"FilterSet mismatch for %s on %s"%(map(str,subset),i)
+    assert len(FilterSet(fs))==5,"Expected five filter groups"
+    assert not FilterSet([])(instances[0]),"Expected an empty FilterSet to match nothing"
+
+    #Pushdown only happens when every include is an exact match on the same API filter
+    (api,local)=planFilters(createFilterList(arguments("-i id=i-e48f12d9 -i id=i-e48f12da".split()).includes))
+    assert api=={"instance-id":["i-e48f12d9","i-e48f12da"]} and local==[],"Expected ids to be pushed down, got %s"%api
+    (api,local)=planFilters(createFilterList(arguments("-i tags.name=Sample2".split()).includes))
+    assert api=={"tag-value":["Sample2"]} and len(local)==1,"Expected tag to be pushed down and kept, got %s"%api
+    for opts in ("-I id=i-e48f12d9","-i id=i-e48f12d9 -i state=running","-i kernel=aki-31990e0b","-i tags.name"):
+        (api,local)=planFilters(createFilterList(arguments(opts.split()).includes))
+        assert api=={} and len(local)==len(opts.split())/2,"Expected no pushdown for %s, got %s"%(opts,api)
+    for (opts,ids) in (("-i state=stopped",["i-e48f12da"]),("-i tags.name=Sample3 -X id=i-e48f12db",[]),
+            ("-i tags.NAME=Sample1 -i tags.tag2=Sample3",["i-e48f12d9"])):
+        args=arguments(opts.split())
+        (api,local)=planFilters(createFilterList(args.includes))
+        results=list(filtered(getAllInstances(apiFilters=api),local,createFilterList(args.excludes)))
+        assert [i.id for i in results]==ids,"Expected %s for %s, got %s"%(ids,opts,map(str,results))
+
+    #The inventory cache should serve a second scan without fetching, until it expires
+    (handle,path)=tempfile.mkstemp(suffix=".sqlite")
+    os.close(handle)
+    try:
+        fetches=[]
+        def counting(region,pageSize,apiFilters,fields):
+            fetches.append(region)
+            return getInstancePages(region,pageSize,apiFilters,fields)
+        cache=InventoryCache(path,ttl=60)
+        results=list(getRegionInstances(["r1"],pager=cache.pager("a1",source=counting)))
+        assert len(results)==3 and fetches==["r1"],"Expected a scan of r1, got %s"%fetches
+        results=list(getRegionInstances(["r1"],pager=cache.pager("a1",source=counting),apiFilters={"instance-state-name":["stopped"]}))
+        assert [i.id for i in results]==["i-e48f12da"] and fetches==["r1"],"Expected a filtered cached scan"
+        assert results[0].isTest() and results[0].region=="r1" and results[0].tags["name"]=="Sample2"
+        list(getRegionInstances(["r1"],pager=cache.pager("a2",source=counting)))
+        assert fetches==["r1","r1"],"Expected another account to scan again"
+        list(getRegionInstances(["r1"],pager=cache.pager("a1",refresh=True,source=counting)))
+        assert fetches==["r1"]*3,"Expected refresh to scan again"
+        list(getRegionInstances(["r1"],pager=InventoryCache(path,ttl=-1).pager("a1",source=counting)))
+        assert fetches==["r1"]*4,"Expected an expired inventory to scan again"
+        class Keyed(FakeBackend):
+            """A backend with an access key, that counts the calls that find its account."""
+            calls=0
+            def accessKey(self):
+                return "AKIDEXAMPLE"
+            def account(self):
+                Keyed.calls+=1
+                return FakeBackend.account(self)
+        backend=BACKEND
+        BACKEND=Keyed(eval(TESTDATA),account="111")
+        try:
+            assert [accountKey(cache),accountKey(InventoryCache(path))]==["111"]*2 and Keyed.calls==1,"Expected one lookup"
+        finally:
+            BACKEND=backend
+        assert "AKIDEXAMPLE" not in open(path,"rb").read(),"Expected only a hash of the access key to be stored"
+    finally:
+        os.remove(path)
+
+    #Assumed-role sessions should be kept until they're about to expire
+    assert accountId("arn:aws:iam::123456789012:role/Reaper")=="123456789012","Expected the account id from the ARN"
+    for arn in ("123456789012","arn:aws:iam::me:role/Reaper"):
+        try:
+            accountId(arn)
+            assert False,"Expected %s not to be a role ARN"%arn
+        except ValueError:
+            pass
+    assumed=[]
+    def assume(arn):
+        assumed.append(arn)
+        return {"access_key":"k%d"%len(assumed),"secret_key":"s","session_token":"t","expiration":clock.now+3600}
+    clock=Clock()
+    sessions=Sessions(margin=300,assume=assume,clock=clock)
+    assert sessions.get("a")["access_key"]=="k1" and sessions.get("a")["access_key"]=="k1","Expected a cached session"
+    clock.now=3300
+    assert sessions.get("a")["access_key"]=="k2" and assumed==["a","a"],"Expected an expiring session to be replaced"
+
+    #A refreshed session should replace the connections for its account, not add to them
+    class Boto:
+        """Stands in for the boto module, making a tuple of the region and access key for each connection."""
+        class ec2:
+            @staticmethod
+            def connect_to_region(region,aws_access_key_id=None,**kwargs):
+                return (region,aws_access_key_id)
+    BOTO=Boto
+    try:
+        for key in ("k1","k2"):
+            credentials={"access_key":key,"secret_key":"s","session_token":"t"}
+            assert getConnection("r1",credentials,"111")==("r1",key) and getConnection("r1",credentials,"111")==("r1",key)
+            assert getConnection("r1",dict(credentials,access_key="x"+key),"222")==("r1","x"+key)
+        assert getConnection("r1")==("r1",None) and getConnection("r2")==("r2",None),"Expected default connections"
+        assert sorted(CONNECTIONS)==[("r1",None),("r1","111"),("r1","222"),("r2",None)],"Expected a connection per account and region"
+    finally:
+        BOTO=None
+        CONNECTIONS.clear()
+
+    #Several accounts should be scanned by a pool of processes, and acted on through their own backends
+    class Placed(object):
+        """Stands in for a boto instance, which keeps some attributes as properties."""
+        def __init__(self):
+            (self.id,self.tags,self._zone)=("p1",{},"ap-southeast-2b")
+        placement=property(lambda self: self._zone)
+        state=property(lambda self: "running")
+    class Overlapping(Backend):
+        """Each scan waits (for up to five seconds) until two scans have been in progress at the same time in
+        different processes.  Once that has happened, no scan waits at all."""
+        def __init__(self):
+            (self.active,self.most)=(multiprocessing.Value('i',0),multiprocessing.Value('i',0))
+        def pages(self,region,pageSize=PAGESIZE,apiFilters=None,fields=()):
+            with self.active.get_lock():
+                self.active.value+=1
+                self.most.value=max(self.most.value,self.active.value)
+            deadline=time.time()+5
+            while self.most.value<2 and time.time()<deadline:
+                time.sleep(0.01)
+            yield [Instance(Placed(),fields)]
+            with self.active.get_lock():
+                self.active.value-=1
+    overlapping=Overlapping()
+    results=list(getAccountInstances({"111":overlapping,"222":overlapping},["r1","r2"],processes=4))
+    assert overlapping.most.value>=2,"Expected pairs to be scanned at the same time"
+    assert [(i.placement,i.state) for i in results]==[("ap-southeast-2b","running")]*4,"Expected properties to be kept"
+    assert arguments("--accounts arn:aws:iam::1:role/a,arn:aws:iam::2:role/b".split()).accounts==["arn:aws:iam::1:role/a",
+        "arn:aws:iam::2:role/b"] and arguments([]).processes==ACCOUNTPROCESSES,"Expected a list of roles"
+    backend=BACKEND
+    BACKEND=FakeBackend(eval(TESTDATA))
+    try:
+        with silenced("stderr"):
+            BACKENDS.update(accountBackends(["arn:aws:iam::%d:role/r"%n for n in (111,222)]+["bogus"]))
+            assert sorted(BACKENDS)==["111","222"] and BACKENDS["111"] is BACKEND.forAccount("arn:aws:iam::111:role/x")
+            report={}
+            results=list(getAccountInstances(BACKENDS,["r1","r2"],processes=4,report=report))
+            assert sorted((i.account,i.region,i.id) for i in results)==sorted((a,r,i.id) for a in ("111","222")
+                for r in ("r1","r2") for i in instances),"Expected every instance of every pair"
+            assert sorted(report)==[("111","r1"),("111","r2"),("222","r1"),("222","r2")] and report[("222","r2")][0]==3
+            BACKENDS["333"]=None
+            results=list(getAccountInstances(BACKENDS,["r1"],report=report))
+            assert len(results)==6 and report[("333","r1")][2].startswith("AttributeError"),"Expected only account 333 to fail"
+            del BACKENDS["333"]
+            batcher=ActionBatcher()
+            act([i for i in results if i.id=="i-e48f12d9"],"stop",batcher)
+            batcher.flush()
+            assert sorted((r.account,r.region,r.succeeded) for r in batcher.results)==[("111","r1",["i-e48f12d9"]),
+                ("222","r1",["i-e48f12d9"])],"Expected a batch for each account, got %s"%batcher.results
+            assert [i.state for i in liveInstances(results[:1],[],[])]==["stopped"],"Expected the account's own state"
+            assert BACKENDS["222"].instances("r2",["i-e48f12d9"])[0].state=="running","Expected other regions to be unaffected"
+            batcher=ActionBatcher()
+            plan=[{"account":a,"region":"r1","id":"i-e48f12da","action":"start","state":"stopped"} for a in ("111","999")]
+            assert applyPlan(plan,batcher)==1,"Expected the plan entry for an account that wasn't reached to be skipped"
+            batcher.flush()
+            assert [(r.account,r.succeeded) for r in batcher.results]==[("111",["i-e48f12da"])],"Expected only account 111"
+    finally:
+        BACKEND=backend
+        BACKENDS.clear()
+
+    #Cached instances must be checked again before they're acted on
+    stale=[Instance({"id":i,"state":"running","region":"r1"}) for i in ("i-e48f12d9","i-e48f12da","i-e48f12db","i-gone")]
+    results=list(liveInstances(stale,createFilterList([("state","running",False),("state","stopped",False)]),[],chunkSize=3))
+    assert [(i.id,i.state) for i in results]==[("i-e48f12d9","running"),("i-e48f12da","stopped")],"Expected live states"
+    backend=BACKEND
+    BACKEND=FakeBackend(lambda n: {"id":"l%d"%n,"state":"running"},count=450)
+    try:
+        assert len(list(liveInstances([Instance({"id":"l%d"%n,"region":"r1"}) for n in xrange(450)],[],[])))==450
+        assert BACKEND.calls==3,"Expected ids to be checked in chunks of WAITCHUNK, got %d calls"%BACKEND.calls
+    finally:
+        BACKEND=backend
+
+    #A filter pushed down to the API must still be checked against the live state of a cached instance
+    (handle,path)=tempfile.mkstemp(suffix=".sqlite")
+    os.close(handle)
+    backend=BACKEND
+    BACKEND=FakeBackend(eval(TESTDATA))
+    try:
+        with silenced("stdout"):
+            work(arguments(("-r r1 --cache %s"%path).split()))
+            BACKEND.act("start","r1",["i-e48f12da"])
+            work(arguments(("-r r1 --cache %s -i state=stopped --terminate"%path).split()))
+            assert BACKEND.instances("r1",["i-e48f12da"])[0].state=="running","Expected the started instance not to be terminated"
+    finally:
+        BACKEND=backend
+        os.remove(path)
+
+    #The cache must hold attributes that boto instances keep as properties, and those that aren't simple
+    placed=Placed()
+    placed.groups=[o1]
+    cached=snapshot(Instance(placed),"r1")
+    assert (cached["placement"],cached["state"],cached["placement_group"])==("ap-southeast-2b","running",None),"Expected properties"
+    assert cached["groups"]==[unicode(o1)],"Expected an object to be cached as its unicode representation"
+    (handle,path)=tempfile.mkstemp(suffix=".sqlite")
+    os.close(handle)
+    outputs=[]
+    stdout=sys.stdout
+    try:
+        for n in xrange(2):
+            sys.stdout=StringIO.StringIO()
+            work(arguments(("-r r1 --cache %s --output jsonl --fields id,state_reason,groups,block_device_mapping"%path).split()))
+            outputs.append(sys.stdout.getvalue())
+    finally:
+        sys.stdout=stdout
+        os.remove(path)
+    assert outputs[0]==outputs[1] and '"groups":["dummy"]' in outputs[1],"Expected the same rows from the cache, got %s"%outputs
+
+    #Watching should pass on only new and changed instances, and report those gone
+    assert arguments("--watch 30".split()).watch==30,"Expected watch interval of 30"
+    scans=[[Instance({"id":"w1","state":"running"}),Instance({"id":"w2","state":"running","kernel":"k1"})],
+        [Instance({"id":"w2","state":"running","kernel":"k2"}),Instance({"id":"w3"})],
+        [Instance({"id":"w2","state":"running","kernel":"k2","ramdisk":"r"}),Instance({"id":"w3","tags":{"a":"b"}})]]
+    processed=[]
+    def process(instances):
+        processed.append([i.id for i in instances])
+    with silenced("stdout"):
+        watch(0,lambda report: scans.pop(0),process,["kernel"],count=3)
+    assert processed==[["w1","w2"],["w2","w3"],["w3"]],"Expected only new and changed instances, got %s"%processed
+    watcher=Watcher()
+    list(watcher.delta([Instance({"id":"w1"}),Instance({"id":"w2"})]))
+    assert list(watcher.delta([Instance({"id":"w2"})]))==[] and watcher.gone==[(None,None,"w1")],"Expected w1 to be gone"
+
+    #An instance in a region that failed to scan isn't gone, and isn't new when the region comes back
+    watcher=Watcher()
+    list(watcher.delta([Instance({"id":"w1","region":"r1"}),Instance({"id":"w2","region":"r2","account":"111"})]))
+    failures={"r1":(0,0.1,RuntimeError("failed")),"r2":(1,0.1,None)}
+    assert list(watcher.delta([Instance({"id":"w2","region":"r2","account":"111"})],failures))==[] and watcher.gone==[]
+    failures={("111","r2"):(0,0.1,"RuntimeError: failed")}
+    assert list(watcher.delta([Instance({"id":"w1","region":"r1"})],failures))==[] and watcher.gone==[],"Expected nothing gone"
+    assert list(watcher.delta([Instance({"id":"w1","region":"r1"})],{}))==[] and watcher.gone==[("111","r2","w2")]
+
+    #An instance that stops matching a filter that could be pushed down isn't gone either
+    class Interrupting(StringIO.StringIO):
+        """Stands in for stdout, interrupting a --watch run once the given scan is reported."""
+        def __init__(self,scans=2):
+            StringIO.StringIO.__init__(self)
+            self.last="Scan %d:"%scans
+        def write(self,text):
+            StringIO.StringIO.write(self,text)
+            if text.startswith(self.last):
+                raise KeyboardInterrupt()
+    backend=BACKEND
+    BACKEND=FakeBackend(eval(TESTDATA))
+    stdout=sys.stdout
+    sys.stdout=Interrupting()
+    try:
+        work(arguments("-r r1 -i state=running --stop --watch 0.01 -v".split()))
+        output=sys.stdout.getvalue()
+    finally:
+        sys.stdout=stdout
+        BACKEND=backend
+    assert "Scan 2: 0 new, 1 changed, 0 gone" in output and "Gone:" not in output,"Expected nothing gone, got %s"%output
+
+    #An instance whose action failed should be tried again after the next scan, though it hasn't changed
+    processed=[]
+    def process(instances):
+        processed.append([i.id for i in instances])
+        if len(processed)<3:
+            return [(None,None,"w1")]
+    with silenced("stdout"):
+        watch(0,lambda report: [Instance({"id":"w1","state":"running"})],process,count=4)
+    assert processed==[["w1"]]*3+[[]],"Expected w1 to be passed on until it succeeded, got %s"%processed
+    class Refusing(FakeBackend):
+        def act(self,action,region,ids):
+            raise RejectedError("UnauthorizedOperation","You are not authorized to perform this operation")
+    backend=BACKEND
+    BACKEND=Refusing(eval(TESTDATA))
+    stdout=sys.stdout
+    sys.stdout=Interrupting(3)
+    try:
+        with silenced("stderr"):
+            work(arguments("-r r1 -i tags.name=Sample1 --stop --watch 0.01 -v".split()))
+        output=sys.stdout.getvalue()
+    finally:
+        sys.stdout=stdout
+        BACKEND=backend
+    assert output.count("Stopping id:i-e48f12d9")==3,"Expected the failed stop to be tried after every scan, got %s"%output
+
+    #Statistics should report percentiles per operation, and be written in either format
+    stats=Stats()
+    for n in xrange(1,101):
+        stats.call("DescribeInstances",n/1000.0)
+    stats.call("StopInstances",0.5)
+    stats.phase("wrap",0.25)
+    assert sum(1 for i in stats.counted("scanned",instances))==3
+    assert stats.timed("filter",lambda x: x*2)(2)==4
+    report=stats.report()
+    assert report["calls"]["DescribeInstances"]["count"]==100,"Expected 100 calls"
+    assert (report["calls"]["DescribeInstances"]["p50"],report["calls"]["DescribeInstances"]["p99"])==(0.05,0.099),"Expected percentiles"
+    assert report["calls"]["StopInstances"]["p90"]==0.5,"Expected the only latency to be every percentile"
+    assert report["instances"]=={"scanned":3} and report["phases"]["wrap"]==0.25 and "filter" in report["phases"]
+    text=stats.prometheus()
+    assert 'reaper_api_latency_seconds{operation="DescribeInstances",quantile="0.9"} 0.090000' in text,"Expected a quantile"
+    assert 'reaper_instances{stage="scanned"} 3' in text,"Expected the scanned count"
+    (handle,path)=tempfile.mkstemp(suffix=".json")
+    os.close(handle)
+    try:
+        stats.write(path)
+        assert json.load(open(path))["calls"]["StopInstances"]["count"]==1,"Expected JSON statistics"
+    finally:
+        os.remove(path)
+    stats.reset()
+    assert stats.report()["calls"]=={} and stats.report()["instances"]=={},"Expected nothing after a reset"
+
+    #The scheduler should keep to its rate, retry throttled calls with backoff, and adapt its concurrency
+    clock=Clock()
+    scheduler=Scheduler(rate=10,burst=2,concurrency=4,retries=3,backoff=1,clock=clock,sleep=clock.sleep)
+    for n in xrange(5):
+        assert scheduler.call("Test",lambda x: x+1,n)==n+1
+    assert abs(clock.now-0.3)<1e-9,"Expected three calls to wait for tokens, slept %s"%clock.now
+    class Throttled(Exception):
+        error_code="RequestLimitExceeded"
+    failures=[2]
+    def flaky():
+        if failures[0]:
+            failures[0]-=1
+            raise Throttled()
+        return "ok"
+    clock.now=0.0
+    assert scheduler.call("Test",flaky)=="ok" and failures==[0],"Expected a throttled call to be retried"
+    assert 0.2<=clock.now<=3.2,"Expected backoff of up to 1+2 seconds, slept %s"%clock.now
+    assert scheduler.limit==2,"Expected the limit to be halved twice then raised once, got %d"%scheduler.limit
+    scheduler.call("Test",lambda: None)
+    scheduler.call("Test",lambda: None)
+    assert scheduler.limit==3,"Expected two successes to raise the limit, got %d"%scheduler.limit
+    failures=[10]
+    try:
+        scheduler.call("Test",flaky)
+        assert False,"Expected the call to fail after its retries"
+    except Throttled:
+        pass
+    assert failures==[6],"Expected four attempts, got %d"%(10-failures[0])
+    try:
+        scheduler.call("Test",lambda: {}["missing"])
+        assert False,"Expected other errors not to be retried"
+    except KeyError:
+        pass
+
+    #Waiting should poll states in bulk until instances converge, fail or time out
+    assert arguments([]).wait is None and arguments(["--wait"]).wait==WAITTIMEOUT,"Expected default wait timeout"
+    assert arguments("--wait 30".split()).wait==30,"Expected wait timeout of 30"
+    states={"a1":["stopping","stopped"],"a2":["stopping","stopping","stopping"],"a3":["terminated"],
+        "a4":["shutting-down"],"a5":[],"b1":["pending","pending","pending"]}
+    calls=[]
+    def fetch(account,region,ids):
+        calls.append(sorted(ids))
+        return [Instance({"id":x,"state":states[x].pop(0)}) for x in ids if states[x]]
+    clock=Clock()
+    waiter=Waiter(chunkSize=3,interval=10,fetch=fetch,clock=clock,sleep=clock.sleep)
+    waiter.track([BatchResult("stop","r1",["a1","a2","a3","a5"],["x1"],None,None),
+        BatchResult("terminate","r2",["a4","a5"],[],None,None),BatchResult("start","r1",["b1"],[],None,"111")])
+    assert len(waiter.pending)==7,"Expected seven instances to wait for"
+    assert not waiter.wait(timeout=15),"Expected not every instance to converge"
+    assert clock.now==15,"Expected to wait until the timeout, waited %s"%clock.now
+    assert sorted(waiter.pending)==[(None,"r1","a2"),("111","r1","b1")],"Expected a2 and b1 to be pending, got %s"%waiter.pending
+    assert sorted((r,i) for (c,r,i,a,s) in waiter.converged)==[("r1","a1"),("r2","a4"),("r2","a5")],"Expected converged"
+    assert sorted((r,i,s) for (c,r,i,a,s) in waiter.failed)==[("r1","a3","terminated"),("r1","a5","not found")],"Expected failures"
+    assert len(calls)==9 and max(map(len,calls))==3,"Expected polls per account and region in chunks of up to three, got %s"%calls
+    assert Waiter(fetch=fetch).wait(),"Expected nothing to wait for"
+
+    #Rules should be read from a file, and the strongest matching action should win
+    (handle,path)=tempfile.mkstemp(suffix=".rules")
+    os.write(handle,"""# Nightly
+--stop -i tags.tag2=victoria
+
+--terminate -i tags.name=Sample2
+-X tags.name=Sample[23]
+--start -I "tags.tag1=Hello D.*"
+""")
+    os.close(handle)
+    try:
+        rules=readRules(path)
+    finally:
+        os.remove(path)
+    assert [r.action for r in rules]==["stop","terminate",None,"start"],"Expected four rules, got %s"%map(str,rules)
+    assert rules[3].filters[0].value.pattern=="Hello D.*","Expected the regex to be parsed with its quotes removed"
+    chosen=[chooseRule(rules,i) for i in instances]
+    assert [r.action for r in chosen]==["stop","terminate","stop"],"Expected stop, terminate, stop, got %s"%map(str,chosen)
+    assert chooseRule(rules[2:3],instances[1]) is None and chooseRule(rules[2:3],instances[0]) is rules[2]
+    assert chooseRule([Rule(action="stop",text="a"),Rule(action="stop",text="b")],o1).text=="a","Expected the first rule to win"
+    try:
+        ruleArguments(["--bogus"])
+        assert False,"Expected a bad rule to raise ValueError"
+    except ValueError:
+        pass
+    batcher=ActionBatcher(backend=FakeBackend(eval(TESTDATA)))
+    with silenced("stdout"):
+        applyRules([Instance(eval(TESTDATA)[n]) for n in xrange(3)],rules,batcher)
+    batcher.flush()
+    assert [(r.action,r.succeeded) for r in batcher.results]==[("stop",["i-e48f12d9"]),("terminate",["i-e48f12da"])]
+
+    #A plan should record what would be done, and applying it should skip instances whose state changed
+    (handle,path)=tempfile.mkstemp(suffix=".plan")
+    os.close(handle)
+    try:
+        planned=[Instance(eval(TESTDATA)[n]) for n in xrange(3)]
+        planned[2].state="running"
+        for i in planned:
+            i.region="ap-southeast-2"
+        writer=PlanWriter(open(path,"w"))
+        with silenced("stdout"):
+            act(planned,"stop",writer)
+            act(planned[1:2],"start",writer)
+        writer.f.close()
+        assert writer.count==3 and [i.state for i in planned]==["running","stopped","running"],"Expected nothing to be acted on"
+        plan=readPlan(path)
+        assert [(e["id"],e["action"],e["state"]) for e in plan]==[("i-e48f12d9","stop","running"),
+            ("i-e48f12db","stop","running"),("i-e48f12da","start","stopped")],"Expected three planned actions, got %s"%plan
+        calls=[]
+        def fetch(account,region,ids):
+            calls.append(ids)
+            return BACKEND.instances(region,ids)
+        batcher=ActionBatcher(backend=FakeBackend(eval(TESTDATA)))
+        with silenced("stderr"):
+            skipped=applyPlan(plan,batcher,chunkSize=2,fetch=fetch)
+        batcher.flush()
+        assert skipped==1,"Expected the instance that has since terminated to be skipped"
+        assert calls==[["i-e48f12d9","i-e48f12db"],["i-e48f12da"]],"Expected bulk state checks, got %s"%calls
+        assert sorted((r.action,r.succeeded) for r in batcher.results)==[("start",["i-e48f12da"]),("stop",["i-e48f12d9"])]
+        for line in ('{"id":"i-1","action":"explode","region":"r1","state":"running"}',
+                '{"id":"i-e48f12d9","action":"stop","state":"running"}','{"id":"i-e48f12d9","action":"stop","region":"r1"}'):
+            open(path,"w").write('{"id":"i-2","action":"stop","region":"r1","state":"running"}\n'+line+"\n")
+            try:
+                readPlan(path)
+                assert False,"Expected a bad plan to raise ValueError: %s"%line
+            except ValueError,e:
+                assert "line 2" in str(e),"Expected the line number, got %s"%e
+    finally:
+        os.remove(path)
+
+    #Batched actions should be grouped by action and region, and sent when a batch is full
+    b1=[Instance({"id":"b%d"%n,"region":"r1"}) for n in xrange(5)]
+    b2=[Instance({"id":"c%d"%n,"region":"r2"}) for n in xrange(2)]
+    backend=FakeBackend([{"id":i.id,"state":"running"} for i in b1+b2])
+    batcher=ActionBatcher(batchSize=2,backend=backend)
+    for i in b1+b2:
+        batcher.add("stop",i)
+    assert len(batcher.results)==3,"Expected three full batches to have been sent, got %d"%len(batcher.results)
+    batcher.flush()
+    assert len(batcher.results)==4,"Expected four batches after flush, got %d"%len(batcher.results)
+    assert [len(r.succeeded) for r in batcher.results]==[2,2,2,1],"Expected batches of 2,2,2,1"
+    assert batcher.results[3]==BatchResult("stop","r1",["b4"],[],None,None),"Expected last batch to hold b4"
+    assert [i.state for i in backend.instances("r1",[i.id for i in b1])]==["stopped"]*5,"Expected r1 to be stopped"
+    states=dict((i.id,i.state) for i in backend.instances("r2",["c0","c1","b0"]))
+    assert states=={"c0":"stopped","c1":"stopped","b0":"running"},"Expected only c0 and c1 to be stopped in r2"
+
+    #A batch that is rejected because of a few instances should be split until just those fail, and only
+    #stopped instances should be started
+    class Strict(Backend):
+        def __init__(self):
+            self.calls=[]
+        def act(self,action,region,ids):
+            self.calls.append(len(ids))
+            if "s3" in ids or "s6" in ids:
+                raise RejectedError("IncorrectInstanceState","s3 or s6 can't be started")
+            if "s9" in ids:
+                raise ThrottledError("RequestLimitExceeded")
+            if "s10" in ids:
+                raise RejectedError("UnauthorizedOperation","You are not authorized to perform this operation")
+            return ids
+    backend=Strict()
+    batcher=ActionBatcher(batchSize=8,backend=backend)
+    with silenced("stderr"):
+        act([Instance({"id":"s%d"%n,"region":"r1","state":"stopped"}) for n in xrange(8)]+
+            [Instance({"id":"s8","region":"r1","state":"stopping"})],"start",batcher)
+        batcher.flush()
+    result=batcher.results[0]
+    assert len(batcher.results)==1 and result.succeeded==["s0","s1","s2","s4","s5","s7"],"Expected the others to start"
+    assert result.failed==["s3","s6"] and result.error.error_code=="IncorrectInstanceState","Expected s3 and s6 to fail, got %s"%(result,)
+    assert backend.calls==[8,4,2,2,1,1,4,2,2,1,1],"Expected the batch to be split in halves, got %s"%backend.calls
+    backend.calls=[]
+    batcher=ActionBatcher(backend=backend)
+    with silenced("stderr"):
+        batcher.add("stop",Instance({"id":"s9","region":"r1"}))
+        batcher.add("stop",Instance({"id":"s0","region":"r1"}))
+        batcher.flush()
+    assert batcher.results[0].failed==["s9","s0"] and backend.calls==[2],"Expected a throttled batch not to be split"
+    backend.calls=[]
+    batcher=ActionBatcher(backend=backend)
+    with silenced("stderr"):
+        for n in (10,0,1,2):
+            batcher.add("stop",Instance({"id":"s%d"%n,"region":"r1"}))
+        batcher.flush()
+    assert batcher.results[0].failed==["s10","s0","s1","s2"] and backend.calls==[4],"Expected an unauthorized batch to be sent once"
+
+    #With more than one call in flight, batches should be sent at the same time by worker threads
+    class Counting(Backend):
+        """Each call waits until two calls have been in progress at the same time.  Once that has happened,
+        no call waits at all.  The timeout only stops a broken batcher from hanging the tests."""
+        def __init__(self):
+            (self.lock,self.active,self.most,self.overlapped)=(threading.Lock(),0,0,threading.Event())
+        def act(self,action,region,ids):
+            with self.lock:
+                self.active+=1
+                self.most=max(self.most,self.active)
+                if self.most>=2:
+                    self.overlapped.set()
+            self.overlapped.wait(5)
+            with self.lock:
+                self.active-=1
+            return [x for x in ids if x!="f3"]
+    backend=Counting()
+    batcher=ActionBatcher(batchSize=2,inFlight=3,backend=backend)
+    with silenced("stderr"):
+        for n in xrange(12):
+            batcher.add("stop",Instance({"id":"f%d"%n,"region":"r1"}))
+        batcher.flush()
+    assert len(batcher.results)==6 and not batcher.workers,"Expected six batches, got %d"%len(batcher.results)
+    assert backend.overlapped.is_set() and backend.most<=3,"Expected up to three calls in flight, got %d"%backend.most
+    assert sorted(x for r in batcher.results for x in r.failed)==["f3"],"Expected f3 to fail"
+    assert arguments([]).inFlight==INFLIGHT and arguments("--in-flight 8".split()).inFlight==8
+
+    #Listed instances should be written with just the chosen fields, in either structured format
+    assert arguments([]).output=="text" and arguments("--output csv".split()).output=="csv","Expected output formats"
+    assert arguments("--fields id,tags.Owner".split()).fields==["id","tags.Owner"],"Expected a list of fields"
+    f=StringIO.StringIO()
+    writer=RowWriter(f,"jsonl",["id","tags.Name","missing","groups","monitored"])
+    assert writer.attributes==["id","missing","groups","monitored"],"Expected the tag not to be an attribute"
+    act(instances[:2],None,None,output=writer)
+    rows=[json.loads(line) for line in f.getvalue().splitlines()]
+    assert rows[1]=={"id":"i-e48f12da","tags.Name":"Sample2","missing":None,"groups":["dummy"],"monitored":False}
+    assert f.getvalue().startswith('{"id":"i-e48f12d9","tags.Name":"Sample1",'),"Expected fields in the order given"
+    f=StringIO.StringIO()
+    writer=RowWriter(f,"csv",["id","state","tags.tag1","state_reason","missing"])
+    writer(instances[2])
+    assert writer.count==1 and f.getvalue().splitlines()[:2]==["id,state,tags.tag1,state_reason,missing",
+        'i-e48f12db,terminated,Hello Dolly,"{""code"": ""Client.UserInitiatedShutdown"", ""message"": '
+        '""Client.UserInitiatedShutdown: User initiated shutdown""}",'],"Expected a header and a row, got %s"%f.getvalue()
+
+    #Filtering should be lazy: the first result must be available before the source is exhausted
+    consumed=[]
+    def source():
+        for i in instances:
+            consumed.append(i)
+            yield i
+    results=filtered(source(),createFilterList([("state","running",False)]),[])
+    assert results.next().id==u'i-e48f12d9',"Expected first instance to pass the filter"
+    assert len(consumed)==1,"Expected only one instance to have been consumed, got %d"%len(consumed)
+
     args=arguments("-i id=i-e48f12d9".split())
-    results=filtered(instances,createFilterList(args.includes),createFilterList(args.excludes))
+    results=list(filtered(instances,createFilterList(args.includes),createFilterList(args.excludes)))
     assert len(results)==1,"Expected one result, got %s"%map(str,results)
 
     args=arguments("-I id=i-e48f12d[9a]".split())
-    results=filtered(instances,createFilterList(args.includes),createFilterList(args.excludes))
+    results=list(filtered(instances,createFilterList(args.includes),createFilterList(args.excludes)))
     assert len(results)==2,"Expected two results, got %s"%map(str,results)
     assert results[0].id=="i-e48f12d9"
     assert results[1].id=="i-e48f12da"
@@ -410,7 +2601,7 @@ def test():
     xFilters=createFilterList(args.excludes)
     assert len(xFilters)==1,"Expected one exclude filter, got %s"%xFilters
 
-    results=filtered(instances,iFilters,xFilters)
+    results=list(filtered(instances,iFilters,xFilters))
     assert len(results)==2,"Expected two results, got %s"%map(str,results)
     assert results[0].id=="i-e48f12d9"
     assert results[1].id=="i-e48f12da"
@@ -418,52 +2609,332 @@ def test():
     args=arguments("-I id=i-e48f12d[ab] -X tags.name=Sample2".split())
     iFilters=createFilterList(args.includes)
     xFilters=createFilterList(args.excludes)
-    results=filtered(instances,iFilters,xFilters)
+    results=list(filtered(instances,iFilters,xFilters))
     assert len(results)==1,"Expected one result, got %s"%map(str,results)
     assert results[0].id=="i-e48f12db"
 
     return True
 
+class Watcher:
+    """Remembers the attributes that matter for filtering and output of every instance seen in a scan,
+    so that the next scan can be reduced to just the instances that are new or changed.  The fields
+    are the names of the attributes used by the filters; state and tags always matter."""
+    def __init__(self,fields=()):
+        self.fields=tuple(fields)
+        #The signature of each instance in the last scan, keyed by (account,region,id)
+        self.seen={}
+        #The results of the last scan: counts of new and changed instances, and (account,region,id) keys of those gone
+        self.new=0
+        self.changed=0
+        self.gone=[]
+
+    def signature(self,instance):
+        """Return a tuple of the attribute values of the instance that matter."""
+        return (getattr(instance,"state",None),tuple(sorted(instance.tags.items())))+tuple(getattr(instance,f,None) for f in self.fields)
+
+    def delta(self,instances,report=None):
+        """A generator that takes all the instances from a scan and yields only those that are new or
+        whose signature has changed since the last scan.  Once it is exhausted, new, changed and gone
+        describe the scan.  If report is given, it is the dict filled in by the scan (see
+        getRegionInstances and getAccountInstances): the instances seen before in a region that failed
+        to scan are remembered as they were, rather than taken to be gone."""
+        (self.new,self.changed,self.gone)=(0,0,[])
+        seen={}
+        for i in instances:
+            key=(getattr(i,"account",None),getattr(i,"region",None),i.id)
+            signature=self.signature(i)
+            seen[key]=signature
+            previous=self.seen.get(key)
+            if previous is None:
+                self.new+=1
+                yield i
+            elif previous!=signature:
+                self.changed+=1
+                yield i
+        #The report is keyed by region, or by (account,region) with --accounts
+        failed=set(k if isinstance(k,tuple) else (None,k) for (k,(count,seconds,error)) in (report or {}).iteritems()
+            if error is not None)
+        for (key,signature) in self.seen.iteritems():
+            if key not in seen and key[:2] in failed:
+                seen[key]=signature
+        self.gone=sorted(k for k in self.seen if k not in seen)
+        self.seen=seen
+
+    def forget(self,keys):
+        """Forget the instances with the given (account,region,id) keys, so that they count as new in the
+        next scan (such as those whose actions failed, so that they're tried again)."""
+        for key in keys:
+            self.seen.pop(key,None)
+
+def watch(interval,scan,process,fields=(),verbose=0,count=None):
+    """Call scan every interval seconds to get all the instances, and pass process an iterator over
+    only those that are new or changed since the previous scan (so the first scan passes them all).
+    Scan is passed a dict to report each region in (as getRegionInstances does), so that a region that
+    fails to scan isn't taken to have lost its instances.  Process may return a list of the
+    (account,region,id) keys of instances whose actions failed: those are passed on again by the next
+    scan, even if they haven't changed.  Instances that have gone since the previous scan are printed.
+    Runs until interrupted, or until count scans have been done."""
+    watcher=Watcher(fields)
+    scans=0
+    while count is None or scans<count:
+        started=time.time()
+        report={}
+        failed=process(watcher.delta(scan(report),report))
+        for (account,region,id) in watcher.gone:
+            print "Gone: id:%s Region:%s%s"%(id,region," Account:%s"%account if account else "")
+        scans+=1
+        if verbose:
+            print "Scan %d: %d new, %d changed, %d gone, %d instances in %.2fs"%(scans,watcher.new,watcher.changed,
+                len(watcher.gone),len(watcher.seen),time.time()-started)
+        watcher.forget(failed or [])
+        if count is None or scans<count:
+            time.sleep(max(0,interval-(time.time()-started)))
+
+class Rule:
+    """A single rule from a rules file: include and exclude filters, and an action (None to just list
+    the matching instances).  Use call syntax to check if a given instance matches the Rule, with the
+    same matching rules as filtered()."""
+
+    #The strength of each action, used to choose between rules that match the same instance
+    PRIORITY={None:0,"start":1,"stop":2,"terminate":3}
+
+    def __init__(self,includes=[],excludes=[],action=None,text=""):
+        self.filters=createFilterList(includes)+createFilterList(excludes)
+        self.includes=FilterSet(createFilterList(includes)) if includes else None
+        self.excludes=FilterSet(createFilterList(excludes)) if excludes else None
+        self.action=action
+        self.text=text
+
+    def __unicode__(self):
+        return u"%s (%s)"%(self.text,self.action or u"list")
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+    def __call__(self,instance):
+        if self.includes is not None and not self.includes(instance):
+            return False
+        return self.excludes is None or not self.excludes(instance)
+
+def readRules(path):
+    """Read the rules file at path and return a list of Rules, in file order.  Raise ValueError if a
+    line can't be parsed."""
+    rules=[]
+    with open(path) as f:
+        for (n,line) in enumerate(f,1):
+            line=line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                a=ruleArguments(shlex.split(line))
+            except ValueError,e:
+                raise ValueError("%s line %d: %s"%(path,n,e))
+            rules.append(Rule(a.includes,a.excludes,a.action,line))
+    return rules
+
+def chooseRule(rules,instance):
+    """Return the Rule that applies to the instance: of those that match, the one with the strongest
+    action, or the first of those with equally strong actions.  Return None if no Rule matches."""
+    chosen=None
+    for rule in rules:
+        if (chosen is None or Rule.PRIORITY[rule.action]>Rule.PRIORITY[chosen.action]) and rule(instance):
+            chosen=rule
+    return chosen
+
+def applyRules(instances,rules,batcher,verbose=0,output=None):
+    """For each of the instances, choose the Rule that applies and act on the instance accordingly."""
+    for i in instances:
+        rule=chooseRule(rules,i)
+        if rule is not None:
+            if verbose>1:
+                print "Rule %s applies to %s"%(rule,i)
+            act([i],rule.action,batcher,verbose,output)
+
+def act(instances,action,batcher,verbose=0,output=None):
+    """List each of the instances if there is no action, by passing it to output (a RowWriter) if that's
+    given, or else printing it.  Otherwise, check the state of each instance and pass it to the batcher if
+    the action can be applied to it."""
+    for i in instances:
+        if not action:
+            if output is not None:
+                output(i)
+            else:
+                print i
+        else:
+            #Get the current state and apply the action if appropriate
+            state=getattr(i,"state",None)
+            if action=="start":
+                if state=="stopped":
+                    if verbose:
+                        print "Starting %s"%i
+                    batcher.add(action,i)
+                else:
+                    if verbose:
+                        print "Not starting %s"%i
+            elif action=="stop":
+                if state in ("pending","running"):
+                    if verbose:
+                        print "Stopping %s"%i
+                    batcher.add(action,i)
+                else:
+                    if verbose:
+                        print "Not stopping %s"%i
+            elif action=="terminate":
+                if state not in ("terminated",):
+                    if verbose:
+                        print "Terminating %s"%i
+                    batcher.add(action,i)
+                else:
+                    if verbose:
+                        print "Not terminating %s"%i
+
+def settle(batcher,args):
+    """Send any actions still pending in the batcher, wait for them to take effect if asked to, and
+    write any statistics.  Return 1 if we waited and any instance did not converge."""
+    batcher.flush()
+    status=None
+    if batcher.results and args.wait is not None:
+        waiter=Waiter(WAITCHUNK,args.waitInterval,args.verbose)
+        waiter.track(batcher.results)
+        if not waiter.wait(args.wait):
+            status=1
+        waiter.summary()
+    #These results have been dealt with
+    batcher.results=[]
+    if args.stats:
+        STATS.write(args.stats,args.statsFormat)
+    return status
+
 def work(args={}):
     """Select instances according to any given filters, then apply any given actions (or just
-    print some instance details if there are no actions)."""
+    print some instance details if there are no actions).  If asked to wait for the actions to take
+    effect, return 1 if any instance did not."""
+    global SCHEDULER
+    SCHEDULER=Scheduler(args.apiRate,args.apiBurst,args.apiConcurrency,args.apiRetries)
+    STATS.enabled=bool(args.stats)
+    if args.accounts:
+        #Assume the role for each account up front: the sessions are needed to act on any of them
+        BACKENDS.clear()
+        BACKENDS.update(accountBackends(args.accounts,args.regionThreads))
+        if not BACKENDS:
+            sys.stderr.write("No accounts could be reached\n")
+            return 1
+    if args.apply:
+        #Everything we need is in the plan, so there's no scan
+        try:
+            plan=readPlan(args.apply)
+        except (IOError,ValueError),e:
+            sys.stderr.write("Can't read plan: %s\n"%e)
+            return 1
+        batcher=ActionBatcher(args.batchSize,args.verbose,args.inFlight)
+        applyPlan(plan,batcher,WAITCHUNK,args.verbose)
+        return settle(batcher,args)
     region=getattr(args,"region")
     if region:
         action=getattr(args,"action")
-        #Filter all the instances in the region
-        instances=filtered(getAllInstances(region==region),
-            createFilterList(args.includes),
-            createFilterList(args.excludes))
-        for i in instances:
-            if not action:
-                print i
+        rules=None
+        if args.rules:
+            if action:
+                sys.stderr.write("An action can't be given with --rules: each rule has its own action\n")
+                return 1
+            try:
+                rules=readRules(args.rules)
+            except (IOError,ValueError),e:
+                sys.stderr.write("Can't read rules: %s\n"%e)
+                return 1
+            #The strongest action in any rule stands for them all when deciding whether to check states
+            action=max((r.action for r in rules),key=lambda a: Rule.PRIORITY[a]) if rules else None
+        if args.plan and (not action or args.watch):
+            sys.stderr.write("A plan needs an action (or rules with actions), and can't be made with --watch\n")
+            return 1
+        #Push down whatever include filters we can to the API, and apply the rest here.  Not with --watch: the
+        #watcher must see every instance, or one that stops matching a pushed-down filter would look gone.
+        if args.watch:
+            (apiFilters,includes)=({},createFilterList(args.includes))
+        else:
+            (apiFilters,includes)=planFilters(createFilterList(args.includes))
+        excludes=createFilterList(args.excludes)
+        if args.verbose:
+            if apiFilters:
+                print "Filters pushed down to the API: %s"%", ".join("%s=%s"%(k,",".join(v)) for (k,v) in sorted(apiFilters.items()))
             else:
-                #Get the current state and apply the action if appropriate
-                state=getattr(i,"state",None)
-                if action=="start":
-                    if state not in ("running","pending","terminated"):
-                        if args.verbose:
-                            print "Starting %s"%i
-                        i.start()
-                    else:
-                        if args.verbose:
-                            print "Not starting %s"%i
-                elif action=="stop":
-                    if state in ("pending","running"):
-                        if args.verbose:
-                            print "Stopping %s"%i
-                        i.stop()
-                    else:
-                        if args.verbose:
-                            print "Not stopping %s"%i
-                elif action=="terminate":
-                    if state not in ("terminated"):
-                        if args.verbose:
-                            print "Terminating %s"%i
-                        i.terminate()
-                    else:
-                        if args.verbose:
-                            print "Not terminating %s"%i
+                print "No filters pushed down to the API"
+        fields=filterFields(includes+excludes+[f for r in (rules or []) for f in r.filters])
+        if args.fields and args.output=="text":
+            sys.stderr.write("Fields can only be chosen for --output jsonl or csv\n")
+            return 1
+        output=None
+        if args.output!="text":
+            #Rows are written as the instances stream through, with any attributes they need fetched up front.
+            #Rows from several accounts always say which account they came from.
+            outputFields=args.fields or OUTPUTFIELDS
+            if args.accounts and "account" not in outputFields:
+                outputFields=["account"]+list(outputFields)
+            output=RowWriter(sys.stdout,args.output,outputFields)
+            fields=sorted(set(fields+output.attributes))
+        regions=resolveRegions(region)
+        if args.plan:
+            #Instances to be acted on are written to the plan instead
+            batcher=PlanWriter(open(args.plan,"w"))
+        else:
+            #Actions are collected and sent in batches
+            batcher=ActionBatcher(args.batchSize,args.verbose,args.inFlight)
+
+        def dispose(instances):
+            """Apply the rules, or the action, to the selected instances."""
+            if rules is not None:
+                applyRules(instances,rules,batcher,args.verbose,output)
+            else:
+                act(instances,action,batcher,args.verbose,output)
+
+        def scan(refresh,report=None):
+            """Return an iterator over all the instances in the regions (of every account, with --accounts),
+            using the inventory cache if asked to.  Each region is reported in report, if it's given."""
+            cache=InventoryCache(args.cache,args.cacheTtl) if args.cache else None
+            if args.accounts:
+                instances=getAccountInstances(BACKENDS,regions,args.pageSize,args.processes,args.verbose,report,
+                    apiFilters=apiFilters,fields=fields,cache=cache,refresh=refresh)
+            else:
+                pager=cache.pager(accountKey(cache),refresh,args.verbose) if cache else None
+                instances=getRegionInstances(regions,args.pageSize,args.regionThreads,args.verbose,report,
+                    pager=pager,apiFilters=apiFilters,fields=fields)
+            return STATS.counted("scanned",instances)
+
+        if args.watch:
+            #Every scan is live, but keep the inventory cache up to date for other runs if asked to
+            def rescan(report):
+                #The statistics written after each scan describe just that scan, and don't grow without bound
+                STATS.reset()
+                if args.accounts:
+                    #Replace any sessions that are about to expire
+                    BACKENDS.update(accountBackends(args.accounts,args.regionThreads))
+                return scan(True,report)
+            def process(instances):
+                """Act on the new and changed instances, and return the keys of those whose actions failed
+                (which settle discards), so that they're tried again after the next scan."""
+                dispose(STATS.counted("matched",filtered(instances,includes,excludes)))
+                batcher.flush()
+                failed=[(r.account,r.region,id) for r in batcher.results for id in r.failed]
+                settle(batcher,args)
+                return failed
+            try:
+                watch(args.watch,rescan,process,fields,args.verbose)
+            except KeyboardInterrupt:
+                pass
+            return
+        #Filter all the instances in the regions
+        instances=filtered(scan(args.refresh),includes,excludes)
+        if action and args.cache and not args.plan:
+            #Never act on cached data: check the selected instances again against every include, pushed
+            #down or not, before acting on them (a plan is checked when it's applied)
+            instances=liveInstances(instances,createFilterList(args.includes),excludes,fields)
+        dispose(STATS.counted("matched",instances))
+        status=settle(batcher,args)
+        if args.plan:
+            batcher.f.close()
+            if args.verbose:
+                print "Planned actions for %d instances in %s"%(batcher.count,args.plan)
+        return status
     else:
         sys.stderr.write("No region specified\n")
 
@@ -473,4 +2944,4 @@ if __name__ == "__main__":
         print "All tests passed"
         sys.exit(0)
     else:
-        work(arguments(sys.argv[1:]))
+        sys.exit(work(arguments(sys.argv[1:])))